@@ -2,41 +2,117 @@
 
 import sys
 from functools import partial
-from typing import List, Dict
+from typing import List, Dict, Optional, Set, Callable, Awaitable
 import os
 import asyncio
+import signal
 
 import psutil
-from pyxs import PyXSError
+import pyudev
 
-from auto_usb_attach.qmp import Qmp
+from auto_usb_attach.qmp import Qmp, QmpError
 from .options import Options
 from .xendomain import XenDomain, XenError
+from .xenstore import XenstoreError
 from .devicemonitor import DeviceMonitor
 from .device import Device
 from .xenusb import XenUsb
+from .retry import RetryScheduler, RetryPolicy
+from .trace import TraceRecorder
+from .udevrules import write_udev_rules
+from .profiling import Profiler
+from .daemon import SystemdNotifier, daemonize, redirect_output
+
+STARTUP_RETRY_POLICY = RetryPolicy(initial_delay=0.02, max_delay=1.0)
+ATTACH_RETRY_POLICY = RetryPolicy(initial_delay=0.05, max_delay=2.0, deadline=30.0)
+DETACH_RETRY_POLICY = RetryPolicy(initial_delay=0.05, max_delay=2.0, deadline=30.0)
+COMPACTION_INTERVAL = 10.0
 
 
 class MainThread:
+    def __get_attach(self, domain: XenDomain, device: Device) -> Callable[[], Awaitable[None]]:
+        async def attach() -> None:
+            dev_map = await domain.attach_device_to_xen(device)
+            async with self.__device_map_lock:
+                self.__device_map[device.sys_name] = dev_map
+            self.__pending_attaches.pop(device.sys_name, None)
+            self.__update_status()
+
+        return attach
+
+    def __retry_attach(self, domain: XenDomain, device: Device) -> None:
+        self.__options.print_verbose("Attach of {} failed, retrying in the background".format(device.sys_name))
+        pending = self.__retry.defer("attach", self.__get_attach(domain, device), (XenError,), ATTACH_RETRY_POLICY)
+        pending.add_done_callback(partial(self.__attach_settled, device.sys_name))
+        self.__pending_attaches[device.sys_name] = pending
+        self.__update_status()
+
+    # Once a retry has given up, nothing is waiting on it any more
+    def __attach_settled(self, sys_name: str, pending: asyncio.Future) -> None:
+        if self.__pending_attaches.get(sys_name) is pending:
+            del self.__pending_attaches[sys_name]
+            self.__update_status()
+
+    async def __attach_failed(self, domain: XenDomain, device: Device) -> None:
+        self.__retry_attach(domain, device)
+
     async def __add_device(self, domain: XenDomain, device: Device) -> None:
         self.__options.print_debug("add_device event fired: {}".format(device))
         if device.sys_name not in self.__device_map:
             self.__options.print_verbose("Device added: {}".format(device.device_path))
 
             try:
-                dev_map = await domain.attach_device_to_xen(device)
-                with (await self.__device_map_lock):
-                    self.__device_map[device.sys_name] = dev_map
+                await self.__get_attach(domain, device)()
             except XenError:
-                pass
+                self.__retry_attach(domain, device)
+
+    # A burst of arrivals gets its ports in one pass; any that fail are retried one at a time
+    async def __add_devices(self, domain: XenDomain, devices: List[Device]) -> None:
+        self.__options.print_debug("devices_added event fired: {}".format(devices))
+        devices = [d for d in devices if d.sys_name not in self.__device_map]
+        for device in devices:
+            self.__options.print_verbose("Device added: {}".format(device.device_path))
+
+        results = await domain.attach_devices_to_xen(devices)
+        async with self.__device_map_lock:
+            self.__device_map.update((s, r) for s, r in results.items() if isinstance(r, XenUsb))
+        for device in (d for d in devices if isinstance(results[d.sys_name], XenError)):
+            self.__retry_attach(domain, device)
+        self.__update_status()
+
+    def __get_detach(self, domain: XenDomain, sys_name: str, dev_map: XenUsb) -> Callable[[], Awaitable[None]]:
+        async def detach() -> None:
+            if await domain.detach_device_from_xen(dev_map):
+                async with self.__device_map_lock:
+                    if self.__device_map.get(sys_name) == dev_map:
+                        del self.__device_map[sys_name]
+                self.__update_status()
+
+        return detach
+
+    # QEMU may be slow to confirm, or briefly unresponsive; neither should end the monitor
+    def __retry_detach(self, domain: XenDomain, sys_name: str, dev_map: XenUsb) -> None:
+        self.__options.print_verbose("Detach of {} failed, retrying in the background".format(sys_name))
+        self.__retry.defer("detach", self.__get_detach(domain, sys_name, dev_map), (XenError,), DETACH_RETRY_POLICY)
 
     async def __remove_device(self, domain: XenDomain, device: Device) -> None:
         self.__options.print_debug("remove_device event fired: {}".format(device))
+        pending = self.__pending_attaches.pop(device.sys_name, None)
+        if pending is not None:
+            pending.cancel()
         if device.sys_name in self.__device_map:
             self.__options.print_verbose("Removing device: {}".format(device.device_path))
-            if await domain.detach_device_from_xen(self.__device_map[device.sys_name]):
-                with (await self.__device_map_lock):
-                    del self.__device_map[device.sys_name]
+            dev_map = self.__device_map[device.sys_name]
+            try:
+                await self.__get_detach(domain, device.sys_name, dev_map)()
+            except XenError:
+                self.__retry_detach(domain, device.sys_name, dev_map)
+        self.__update_status()
+
+    def __update_status(self) -> None:
+        self.__notifier.status("{} attached, {} waiting to retry, watching {} hubs and {} devices"
+                               .format(len(self.__device_map), len(self.__pending_attaches),
+                                       len(self.__options.hubs), len(self.__options.specific_devices)))
 
     async def __restart_program(self):
         if self.__options.wrapper_name is None:
@@ -67,23 +143,153 @@ class MainThread:
 
         monitor.shutdown()
 
+    # Apply only what changed in the config file: watches that went away are dropped and the devices
+    # they covered are detached, new watches are scanned, and everything else is left attached.
+    async def __reload(self, domain: XenDomain, monitor: DeviceMonitor) -> None:
+        self.__notifier.reloading()
+        try:
+            await self.__apply_reload(domain, monitor)
+        finally:
+            self.__notifier.ready("Reloaded")
+            self.__update_status()
+
+    async def __apply_reload(self, domain: XenDomain, monitor: DeviceMonitor) -> None:
+        async with self.__device_map_lock:
+            old_hubs, old_devices = set(self.__options.hubs), set(self.__options.specific_devices)
+            if not self.__options.reload():
+                return
+            new_hubs, new_devices = set(self.__options.hubs), set(self.__options.specific_devices)
+
+            for h in old_hubs - new_hubs:
+                self.__options.print_verbose("No longer watching hub {}".format(h))
+                monitor.remove_hub(h)
+            for d in old_devices - new_devices:
+                self.__options.print_verbose("No longer watching device {}".format(d))
+                monitor.remove_specific_device(d)
+
+            unwatched = {s for s in self.__device_map.keys() | self.__pending_attaches.keys()
+                         if not monitor.is_watched(s)}
+            for sys_name in unwatched & self.__pending_attaches.keys():
+                self.__pending_attaches.pop(sys_name).cancel()
+            # The new settings are already in place, so one failure can't be allowed to stop the rest
+            for sys_name in unwatched & self.__device_map.keys():
+                dev_map = self.__device_map[sys_name]
+                self.__options.print_verbose("Detaching {}, it is no longer watched".format(sys_name))
+                try:
+                    if await domain.detach_device_from_xen(dev_map):
+                        del self.__device_map[sys_name]
+                except XenError:
+                    self.__retry_detach(domain, sys_name, dev_map)
+
+            added_hubs, added_devices = new_hubs - old_hubs, new_devices - old_devices
+            try:
+                self.__device_map.update(await monitor.add_watches(added_hubs, added_devices))
+            except (RuntimeError, pyudev.DeviceNotFoundError, XenError, XenstoreError, QmpError) as e:
+                self.__options.print_unless_quiet("Could not attach what the new watches cover ({}), retrying in "
+                                                  "the background".format(e))
+                self.__retry.defer("reload scan", partial(self.__scan_watches, monitor, added_hubs, added_devices),
+                                   (XenError, XenstoreError, QmpError), ATTACH_RETRY_POLICY)
+
+    async def __scan_watches(self, monitor: DeviceMonitor, hubs: Set[str], device_ids: Set[str]) -> None:
+        found = await monitor.add_watches(hubs, device_ids)
+        async with self.__device_map_lock:
+            self.__device_map.update(found)
+        self.__update_status()
+
+    # Controllers we created are removed once they have been empty for the grace period.  With consolidation
+    # on, a sparse one is emptied first, but only once udev has been quiet for that long too.
+    async def __compact_controllers(self, domain: XenDomain, monitor: DeviceMonitor) -> None:
+        while True:
+            await asyncio.sleep(COMPACTION_INTERVAL)
+            grace = self.__options.controller_grace
+            if grace <= 0:
+                continue
+
+            try:
+                if self.__options.consolidate_controllers and monitor.idle_for >= grace and \
+                        len(self.__pending_attaches) == 0:
+                    await self.__consolidate_controllers(domain)
+                if len(await domain.reclaim_idle_controllers(grace)) > 0:
+                    self.__update_status()
+            except (XenError, XenstoreError) as e:
+                self.__options.print_unless_quiet("Controller compaction failed: {}".format(e))
+
+    async def __consolidate_controllers(self, domain: XenDomain) -> None:
+        lost = []
+        moved = await domain.consolidate_controllers()
+        async with self.__device_map_lock:
+            for sys_name, (device, dev_map) in moved.items():
+                if dev_map is not None:
+                    self.__device_map[sys_name] = dev_map
+                else:
+                    self.__device_map.pop(sys_name, None)
+                    lost.append(device)
+
+        # Anything that couldn't go back anywhere gets the usual background retries
+        for device in lost:
+            await self.__add_device(domain, device)
+
     def __drop_privileges(self):
         ruid = int(os.getuid() or os.environ.get("SUDO_UID") or 0)
         self.__options.print_debug("Original uid: {}".format(ruid))
         os.setreuid(ruid, ruid)
         self.__options.print_debug("New euid: {}".format(os.geteuid()))
 
-    @staticmethod
-    async def __remove_disconnected_devices(domain: XenDomain, devices: List[XenUsb]):
-        async for dev in domain.get_attached_devices():
-            if dev not in devices:
+    async def __remove_disconnected_devices(self, domain: XenDomain, devices: Set[XenUsb]):
+        attached = {dev async for dev in domain.get_attached_devices()}
+        for dev in attached - devices:
+            try:
                 await domain.detach_device_from_xen(dev)
+            except XenError as e:
+                self.__options.print_unless_quiet("Could not remove stale device {}:{}: {}"
+                                                  .format(dev.hostbus, dev.hostaddr, e))
+
+    async def __startup_scan(self, domain: XenDomain, monitor: DeviceMonitor) -> None:
+        async with self.__device_map_lock:
+            self.__device_map.update(await monitor.add_watches(self.__options.hubs, self.__options.specific_devices))
+            await self.__remove_disconnected_devices(domain, set(self.__device_map.values()))
+
+    # Go through the same startup scan with xenstore writes and QMP commands held back
+    async def __plan(self, domain: XenDomain, monitor: DeviceMonitor) -> None:
+        plan = domain.begin_plan()
+        await self.__startup_scan(domain, monitor)
+        print(plan.report(self.__options.domain, domain.domain_id, self.__recorder.stages))
+
+    @property
+    def options(self) -> Options:
+        return self.__options
+
+    @property
+    def retry(self) -> RetryScheduler:
+        return self.__retry
+
+    @property
+    def recorder(self) -> Optional[TraceRecorder]:
+        return self.__recorder
+
+    def build_monitor(self, xen_domain: XenDomain) -> DeviceMonitor:
+        monitor = DeviceMonitor(self.__options, xen_domain, self.__recorder)
+        monitor.device_added += partial(self.__add_device, xen_domain)
+        monitor.devices_added += partial(self.__add_devices, xen_domain)
+        monitor.attach_failed += partial(self.__attach_failed, xen_domain)
+        monitor.device_removed += partial(self.__remove_device, xen_domain)
+        return monitor
 
     def run(self) -> None:
-        qmp = Qmp(self.__options)
+        if self.__options.udev_rules_file is not None:
+            write_udev_rules(self.__options)
+            return
+
+        if self.__options.daemon and not self.__options.plan:
+            daemonize(self.__options)
+        if self.__options.log_file is not None:
+            redirect_output(self.__options.log_file)
+
+        qmp = Qmp(self.__options, self.__retry, self.__recorder)
 
         async def usb_monitor() -> None:
-            with await XenDomain.wait_for_domain(self.__options, qmp) as xen_domain:
+            self.__notifier.status("Waiting for domain {}".format(self.__options.domain))
+            with await XenDomain.wait_for_domain(self.__options, qmp, self.__retry, self.__recorder) as xen_domain:
                 if xen_domain is None:
                     return
 
@@ -92,46 +298,74 @@ class MainThread:
                 else:
                     await qmp.is_connected.wait()
 
-                monitor = DeviceMonitor(self.__options, xen_domain)
-                monitor.device_added += partial(self.__add_device, xen_domain)
-                monitor.device_removed += partial(self.__remove_device, xen_domain)
-                qmp.domain_reboot += partial(self.__domain_reboot, xen_domain, monitor)
-                qmp.domain_shutdown += partial(self.__domain_shutdown, xen_domain, monitor)
+                monitor = self.build_monitor(xen_domain)
+                if self.__options.qmp_socket is not None:
+                    qmp.domain_reboot += partial(self.__domain_reboot, xen_domain, monitor)
+                    qmp.domain_shutdown += partial(self.__domain_shutdown, xen_domain, monitor)
+                else:
+                    xen_domain.domain_reboot += partial(self.__domain_reboot, xen_domain, monitor)
+                    xen_domain.domain_shutdown += partial(self.__domain_shutdown, xen_domain, monitor)
+                    await xen_domain.watch_lifecycle()
 
                 if self.__options.qmp_socket is not None:
                     self.__drop_privileges()
 
-                while True:
-                    try:
-                        with (await self.__device_map_lock):
-                            for h in self.__options.hubs:
-                                self.__device_map.update(await monitor.add_hub(h))
-                            for d in self.__options.specific_devices:
-                                self.__device_map.update(await monitor.add_specific_device(d))
-                            await self.__remove_disconnected_devices(xen_domain, list(self.__device_map.values()))
-                            break
-                    except PyXSError:
-                        await asyncio.sleep(1.0)
+                if self.__options.plan:
+                    await self.__plan(xen_domain, monitor)
+                    return
+
+                await self.__retry.run("startup scan", partial(self.__startup_scan, xen_domain, monitor),
+                                       (XenstoreError,), STARTUP_RETRY_POLICY)
+                # Only now is everything that was plugged in at startup attached
+                self.__notifier.ready("Startup scan complete")
+                self.__update_status()
+                self.__event_loop.add_signal_handler(
+                    signal.SIGHUP, lambda: asyncio.ensure_future(self.__reload(xen_domain, monitor)))
+                profiler = Profiler(self.__options)
+                profiler.install()
+                compaction = asyncio.ensure_future(self.__compact_controllers(xen_domain, monitor))
 
                 try:
                     await monitor.monitor_devices()
                     return
                 except KeyboardInterrupt:
                     return
+                finally:
+                    compaction.cancel()
+                    profiler.uninstall()
+                    self.__event_loop.remove_signal_handler(signal.SIGHUP)
+                    self.__retry.print_counters()
 
+        heartbeat = asyncio.ensure_future(self.__notifier.heartbeat())
         try:
             if self.__options.qmp_socket is not None:
                 asyncio.ensure_future(qmp.monitor_domain())
             self.__event_loop.run_until_complete(usb_monitor())
         except KeyboardInterrupt:
             pass
+        finally:
+            heartbeat.cancel()
+            self.__notifier.stopping()
+            self.__notifier.close()
+            if self.__recorder is not None:
+                self.__recorder.close()
 
-    def __init__(self, args):
+    def __init__(self, args, recorder: Optional[TraceRecorder] = None):
         super().__init__()
         self.__args = args
         self.__options = Options(args)
+        self.__recorder = recorder
+        if self.__recorder is None and self.__options.record_file is not None:
+            self.__recorder = TraceRecorder(self.__options, self.__options.record_file)
+            self.__recorder.header(self.__options)
+        if self.__recorder is None and self.__options.plan:
+            # Only kept in memory, for the round trip counts and latencies in the plan
+            self.__recorder = TraceRecorder(self.__options, None)
         self.__device_map: Dict[str, XenUsb] = {}
         self.__device_map_lock = asyncio.Lock()
+        self.__pending_attaches: Dict[str, asyncio.Future] = {}
+        self.__retry = RetryScheduler(self.__options)
+        self.__notifier = SystemdNotifier(self.__options)
         self.__event_loop = asyncio.get_event_loop()
 
     def __repr__(self):
@@ -0,0 +1,83 @@
+import json
+import os
+import re
+from typing import Any, Dict, FrozenSet, Iterable, Optional
+
+from .options import Options
+from .paths import private_directory
+
+# query-commands output from the QEMU this was first written against, used when a device model
+# can't tell us itself
+SEED_FILE = os.path.join(os.path.dirname(__file__), "qmp-commands.json")
+
+
+# The commands one QEMU build supports.  They only change with the binary, so they are kept on disk
+# keyed by the version from the QMP greeting, and asked for again only when that version changes.
+class QmpCapabilities:
+    @property
+    def version(self) -> Optional[str]:
+        return self.__version
+
+    @property
+    def commands(self) -> FrozenSet[str]:
+        return self.__commands
+
+    def has(self, command: str) -> bool:
+        return command in self.__commands
+
+    @staticmethod
+    def version_from_greeting(greeting: Dict[str, Any]) -> Optional[str]:
+        version = greeting.get("QMP", {}).get("version", {})
+        qemu = version.get("qemu")
+        if qemu is None:
+            return None
+        return "{}.{}.{}{}".format(qemu.get("major"), qemu.get("minor"), qemu.get("micro"),
+                                   version.get("package", "").strip())
+
+    @staticmethod
+    def __cache_path(options: Options, version: str) -> str:
+        return os.path.join(options.cache_dir, "qmp-{}.json".format(re.sub(r"[^A-Za-z0-9.+_-]", "_", version)))
+
+    @staticmethod
+    def __read(path: str) -> Optional[FrozenSet[str]]:
+        try:
+            with open(path) as commands_file:
+                return frozenset(c["name"] for c in json.load(commands_file)["return"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    # Whatever is in the cache is trusted, so only read it from a directory nobody else can write to
+    @staticmethod
+    def load(options: Options, version: Optional[str]) -> Optional["QmpCapabilities"]:
+        if version is None:
+            return None
+        try:
+            private_directory(options.cache_dir)
+        except OSError as e:
+            options.print_verbose("Not using the QMP capability cache: {}".format(e))
+            return None
+        commands = QmpCapabilities.__read(QmpCapabilities.__cache_path(options, version))
+        return QmpCapabilities(version, commands) if commands is not None else None
+
+    @staticmethod
+    def seed(version: Optional[str]) -> "QmpCapabilities":
+        return QmpCapabilities(version, QmpCapabilities.__read(SEED_FILE) or frozenset())
+
+    def save(self, options: Options) -> None:
+        if self.__version is None:
+            return
+        path = self.__cache_path(options, self.__version)
+        try:
+            private_directory(options.cache_dir)
+            with open(path + ".tmp", "w") as commands_file:
+                json.dump({"return": [{"name": c} for c in sorted(self.__commands)]}, commands_file)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            options.print_verbose("Could not cache QMP capabilities in {}: {}".format(path, e))
+
+    def __init__(self, version: Optional[str], commands: Iterable[str]):
+        self.__version = version
+        self.__commands = frozenset(commands)
+
+    def __repr__(self):
+        return "QmpCapabilities({!r}, {} commands)".format(self.__version, len(self.__commands))
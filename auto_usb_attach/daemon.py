@@ -0,0 +1,97 @@
+import asyncio
+import os
+import socket
+import sys
+from typing import Optional
+
+from .options import Options
+
+
+# Classic double fork.  Under systemd (NOTIFY_SOCKET is set) we stay in the foreground instead,
+# so the service manager keeps track of the right pid and gets our notifications.
+def daemonize(options: Options) -> None:
+    if "NOTIFY_SOCKET" in os.environ:
+        options.print_verbose("Started by systemd, not forking")
+        return
+
+    if os.fork() > 0:
+        os._exit(0)
+    os.setsid()
+    if os.fork() > 0:
+        os._exit(0)
+
+    os.chdir("/")
+    os.umask(0o022)
+    with open(os.devnull) as devnull:
+        os.dup2(devnull.fileno(), sys.stdin.fileno())
+    if options.log_file is None:
+        redirect_output(os.devnull)
+
+
+def redirect_output(path: str) -> None:
+    sys.stdout.flush()
+    sys.stderr.flush()
+    output = open(path, "a", buffering=1)
+    os.dup2(output.fileno(), sys.stdout.fileno())
+    os.dup2(output.fileno(), sys.stderr.fileno())
+
+
+# Speaks the sd_notify datagram protocol directly; does nothing when not started by systemd
+class SystemdNotifier:
+    @property
+    def is_enabled(self) -> bool:
+        return self.__socket is not None
+
+    @property
+    def watchdog_interval(self) -> Optional[float]:
+        usec = os.environ.get("WATCHDOG_USEC")
+        pid = os.environ.get("WATCHDOG_PID")
+        if usec is None or (pid is not None and int(pid) != os.getpid()):
+            return None
+        return int(usec) / 1000000
+
+    def __notify(self, message: str) -> None:
+        if self.__socket is None:
+            return
+        try:
+            self.__socket.sendto(bytes(message, "utf-8"), self.__address)
+        except OSError as e:
+            self.__options.print_debug("sd_notify failed: {}".format(e))
+
+    def ready(self, status: str) -> None:
+        self.__notify("READY=1\nSTATUS={}".format(status))
+
+    def status(self, status: str) -> None:
+        self.__notify("STATUS={}".format(status))
+
+    def reloading(self) -> None:
+        self.__notify("RELOADING=1")
+
+    def stopping(self) -> None:
+        self.__notify("STOPPING=1")
+
+    # Pinged from the event loop, so a stalled loop stops the heartbeat and systemd restarts us
+    async def heartbeat(self) -> None:
+        interval = self.watchdog_interval
+        if self.__socket is None or interval is None:
+            return
+        while True:
+            self.__notify("WATCHDOG=1")
+            await asyncio.sleep(interval / 2)
+
+    def close(self) -> None:
+        if self.__socket is not None:
+            self.__socket.close()
+            self.__socket = None
+
+    def __init__(self, options: Options):
+        self.__options = options
+        self.__socket = None
+        self.__address = os.environ.get("NOTIFY_SOCKET")
+        if self.__address is not None:
+            if self.__address.startswith("@"):
+                self.__address = "\0" + self.__address[1:]
+            self.__socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    def __repr__(self):
+        return "SystemdNotifier({!r})".format(self.__options)
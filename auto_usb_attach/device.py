@@ -1,4 +1,4 @@
-from typing import Iterable
+from typing import Iterable, FrozenSet, Optional
 import pyudev
 
 
@@ -23,6 +23,25 @@ class Device:
     def product_id(self) -> str:
         return str(self.__inner.attributes.get('idProduct') or b"", "ascii")
 
+    @property
+    def serial(self) -> str:
+        return str(self.__inner.attributes.get('serial') or b"", "ascii", "replace")
+
+    @property
+    def speed(self) -> float:
+        return float(self.__inner.attributes.get('speed') or 0)
+
+    @property
+    def interface_classes(self) -> FrozenSet[int]:
+        classes = set()
+        for child in self.__inner.children:
+            if child.device_type != "usb_interface":
+                continue
+            interface_class = child.attributes.get("bInterfaceClass")
+            if interface_class is not None:
+                classes.add(int(interface_class, 16))
+        return frozenset(classes)
+
     @property
     def sys_name(self) -> str:
         return self.__inner.sys_name
@@ -42,6 +61,13 @@ class Device:
     def is_a_root_device(self) -> bool:
         return "bDeviceClass" in self.__inner.attributes.available_attributes
 
+    @staticmethod
+    def from_sys_name(context: pyudev.Context, sys_name: str) -> Optional["Device"]:
+        try:
+            return Device(pyudev.Devices.from_name(context, "usb", sys_name))
+        except pyudev.DeviceNotFoundError:
+            return None
+
     def __init__(self, inner: pyudev.Device):
         self.__inner = inner
 
@@ -1,5 +1,7 @@
 import asyncio
-from typing import Dict, Iterable, Optional
+import time
+from functools import partial
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 from glob import glob
 
 import pyudev
@@ -7,15 +9,28 @@ import pyudev
 from .xenusb import XenUsb
 from .device import Device
 from .options import Options
-from .xendomain import XenDomain
+from .xendomain import XenDomain, XenError
 from .asyncevent import AsyncEvent
+from .trace import TraceRecorder
+from .priority import AttachPriorities
 
 SYSFS_ROOT = "/sys/bus/usb/devices"
+# How long to keep collecting after a udev event in case more follow (a hub full of devices being plugged in).
+# The window adapts between these bounds, and no burst is held for longer than BURST_LIMIT in total.
+BURST_WINDOW_MIN = 0.01
+BURST_WINDOW_INITIAL = 0.05
+BURST_WINDOW_MAX = 0.25
+BURST_LIMIT = 1.0
 
 
 class DeviceMonitor:
     __context = None
 
+    # Seconds since the last udev event
+    @property
+    def idle_for(self) -> float:
+        return time.monotonic() - self.__last_event
+
     def __devices_of_interest(self, device: Device) -> Iterable['Device']:
         for dev in device.children:
             if self.__is_a_device_we_care_about(dev, device):
@@ -30,29 +45,55 @@ class DeviceMonitor:
         if hub_device is not None:
             return False
 
-        for specific_device in self.__specific_devices:
-            if specific_device[0] == device.vendor_id and specific_device[1] == device.product_id:
-                return True
-
-        return False
+        return (device.vendor_id, device.product_id) in self.__specific_devices
 
-    async def __attach_device(self, device: Device) -> Dict[str, XenUsb]:
-        dev_map = await self.__domain.find_device_mapping(device.sys_name)
-        if dev_map is None:
-            dev_map = await self.__domain.attach_device_to_xen(device)
-        if dev_map is not None:
-            return {device.sys_name: dev_map}
+    async def __existing_mapping(self, device: Device) -> Optional[XenUsb]:
+        dev_map = await self.__domain.find_device_mapping(device)
+        if dev_map is not None and (dev_map.hostbus, dev_map.hostaddr) != (device.busnum, device.devnum):
+            # Same physical port, but the device was re-enumerated while we weren't watching, so QEMU
+            # is holding on to a host address that no longer exists.  Put it back in the same slot.
+            self.__options.print_verbose("{} was re-enumerated, re-attaching to Controller {}, Slot {}"
+                                         .format(device.sys_name, dev_map.controller, dev_map.port))
+            await self.__domain.detach_device_from_xen(dev_map)
+            dev_map = None
 
-        return {}
+        return dev_map
 
-    async def __get_connected_devices(self, hub_device: Device) -> Dict[str, XenUsb]:
+    # Devices that are already attached are kept; the rest are attached as one batch, most urgent first.
+    # Any that fail are handed to attach_failed, and everything else is still returned.  A device whose
+    # stale mapping can't be detached is left alone until it is plugged in again.
+    async def __attach_devices(self, devices: Iterable[Device]) -> Dict[str, XenUsb]:
         device_map = {}
-        for device in self.__devices_of_interest(hub_device):
-            self.__options.print_verbose("Found at startup: {0.device_path}".format(device))
-            device_map.update(await self.__attach_device(device))
+        unattached = []
+        unique = {device.sys_name: device for device in devices}
+        for device in self.__priorities.sort(unique.values()):
+            try:
+                dev_map = await self.__existing_mapping(device)
+            except XenError as e:
+                self.__options.print_unless_quiet("Could not detach the old mapping of {}, skipping it: {}"
+                                                  .format(device.sys_name, e))
+                continue
+            if dev_map is not None:
+                device_map[device.sys_name] = dev_map
+            else:
+                unattached.append(device)
+
+        results = await self.__domain.attach_devices_to_xen(unattached)
+        for device in unattached:
+            if isinstance(results[device.sys_name], XenError):
+                await self.attach_failed.fire(device)
+            else:
+                device_map[device.sys_name] = results[device.sys_name]
 
         return device_map
 
+    def __get_connected_devices(self, hub_device: Device) -> List[Device]:
+        devices = list(self.__devices_of_interest(hub_device))
+        for device in devices:
+            self.__options.print_verbose("Found at startup: {0.device_path}".format(device))
+
+        return devices
+
     def __find_devices(self, vendor_id: str, product_id: str) -> Iterable[Device]:
         for dev_file in glob("{}/*".format(SYSFS_ROOT)):
             if dev_file.split("/")[-1].startswith("usb"):
@@ -65,13 +106,15 @@ class DeviceMonitor:
             if dev.vendor_id == vendor_id and dev.product_id == product_id:
                 yield dev
 
-    async def __add_hub(self, device: Device) -> Dict[str, XenUsb]:
+    def __watch_hub_device(self, device: Device) -> List[Device]:
         if device not in self.__root_devices:
             self.__root_devices.append(device)
+            if self.__recorder is not None:
+                self.__recorder.hub(device)
 
-        return await self.__get_connected_devices(device)
+        return self.__get_connected_devices(device)
 
-    async def add_hub(self, device_name: str) -> Dict[str, XenUsb]:
+    def __watch_hub(self, device_name: str) -> List[Device]:
         inner = pyudev.Devices.from_path(self.__context, "{0}/{1}".format(SYSFS_ROOT, device_name))
 
         dev = Device(inner)
@@ -80,60 +123,192 @@ class DeviceMonitor:
         if not dev.is_a_hub():
             raise RuntimeError("Device {0} is not a hub".format(dev.sys_name))
 
-        return await self.__add_hub(dev)
+        return self.__watch_hub_device(dev)
 
-    async def add_specific_device(self, device_id: str) -> Dict[str, XenUsb]:
-        ret = {}
+    # Watching a pair that is already watched still returns what it matches, so a startup scan that is
+    # retried finds the same devices again
+    def __watch_specific_device(self, device_id: str, scan: bool = True) -> List[Device]:
+        found = []
         vendor_id, product_id = device_id.split(":")
-        if (vendor_id, product_id) in self.__specific_devices:
-            return ret
-
         if vendor_id is None or product_id is None:
             raise RuntimeError("Device {} is not formatted properly. (Should be <vendor_id>:<product_id>)")
 
         self.__options.print_debug("Searching for {}".format(device_id))
-        for dev in self.__find_devices(vendor_id, product_id):
+        for dev in self.__find_devices(vendor_id, product_id) if scan else []:
             self.__options.print_debug("Found device: {!r}".format(dev))
             if dev.is_a_hub():
-                return await self.__add_hub(dev)
-            ret.update(await self.__attach_device(dev))
+                return self.__watch_hub_device(dev)
+            found.append(dev)
+
+        self.__specific_devices.add((vendor_id, product_id))
+        return found
+
+    async def add_hub_device(self, device: Device) -> Dict[str, XenUsb]:
+        return await self.__attach_devices(self.__watch_hub_device(device))
+
+    async def add_hub(self, device_name: str) -> Dict[str, XenUsb]:
+        return await self.__attach_devices(self.__watch_hub(device_name))
 
-        self.__specific_devices.append((vendor_id, product_id))
-        return ret
+    async def add_specific_device(self, device_id: str, scan: bool = True) -> Dict[str, XenUsb]:
+        return await self.__attach_devices(self.__watch_specific_device(device_id, scan))
+
+    # Start watching all of these, then attach everything they cover in a single priority-ordered pass.
+    # A watch that can't be set up is reported and skipped; it doesn't hold up the others.
+    async def add_watches(self, hubs: Iterable[str], device_ids: Iterable[str]) -> Dict[str, XenUsb]:
+        found = []
+        watches = [partial(self.__watch_hub, hub) for hub in hubs] + \
+            [partial(self.__watch_specific_device, device_id) for device_id in device_ids]
+        for watch in watches:
+            try:
+                found.extend(watch())
+            except (RuntimeError, ValueError, pyudev.DeviceNotFoundError) as e:
+                self.__options.print_unless_quiet("Could not watch {}: {}".format(watch.args[0], e))
+
+        return await self.__attach_devices(found)
+
+    def remove_hub(self, device_name: str) -> None:
+        self.__root_devices = [d for d in self.__root_devices if d.sys_name != device_name]
+
+    def remove_specific_device(self, device_id: str) -> None:
+        vendor_id, product_id = device_id.split(":")
+        self.__specific_devices.discard((vendor_id, product_id))
+
+    # Would a device that is plugged in right now still be picked up by the current watch set?
+    def is_watched(self, sys_name: str) -> bool:
+        device = Device.from_sys_name(self.__context, sys_name)
+        return device is not None and self.__is_a_device_we_care_about(device)
 
     def shutdown(self):
         self.__shutdown = True
+        self.__readable.set()
 
     async def monitor_devices(self) -> None:
+        # Let the socket filter drop interface events (and, with a udev tag, everything we don't watch)
+        # so they never wake us up
         monitor = pyudev.Monitor.from_netlink(self.__context)
-        monitor.filter_by('usb')
-
-        while True:
-            if self.__shutdown:
+        monitor.filter_by('usb', device_type='usb_device')
+        if self.__options.udev_tag is not None:
+            monitor.filter_by_tag(self.__options.udev_tag)
+
+        monitor.start()
+
+        while not self.__shutdown:
+            events = await self.__collect_burst(monitor)
+            if len(events) > 0:
+                await self.handle_events(events)
+
+    # The reader is only installed while we wait: it is level-triggered, so left in place it would fire on
+    # every loop iteration while events queue up behind a burst that is still being attached.
+    # For the same reason, clearing first can't lose a wakeup.
+    async def __wait_readable(self, monitor: pyudev.Monitor, timeout: Optional[float]) -> bool:
+        loop = asyncio.get_event_loop()
+        self.__readable.clear()
+        loop.add_reader(monitor.fileno(), self.__readable.set)
+        try:
+            await asyncio.wait_for(self.__readable.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            loop.remove_reader(monitor.fileno())
+
+    # Block until udev has something, then keep collecting while events keep arriving within the window.
+    # The next window is twice the longest gap seen, so a hub that enumerates slowly gets a longer one.
+    # A burst that starts right after the previous one ended counts too, since that one was cut short.
+    # A lone event lets the window shrink back.
+    async def __collect_burst(self, monitor: pyudev.Monitor) -> List[Device]:
+        events = []
+        while len(events) == 0 and not self.__shutdown:
+            await self.__wait_readable(monitor, None)
+            events.extend(Device(d) for d in iter(partial(monitor.poll, 0), None))
+
+        loop = asyncio.get_event_loop()
+        first = last = loop.time()
+        since_previous = first - self.__last_burst_end
+        largest_gap = since_previous if since_previous < BURST_WINDOW_MAX else 0.0
+        while not self.__shutdown and last - first < BURST_LIMIT:
+            if not await self.__wait_readable(monitor, self.__burst_window):
                 break
-
-            device = monitor.poll(0)
-            if device is None:
-                await asyncio.sleep(1.0)
-                continue
-
-            device = Device(device)
+            arrived = [Device(d) for d in iter(partial(monitor.poll, 0), None)]
+            if len(arrived) > 0:
+                largest_gap = max(largest_gap, loop.time() - last)
+                last = loop.time()
+                events.extend(arrived)
+
+        self.__last_burst_end = last
+        window = 2 * largest_gap if largest_gap > 0 else self.__burst_window / 2
+        self.__burst_window = min(BURST_WINDOW_MAX, max(BURST_WINDOW_MIN, window))
+        if len(events) > 1:
+            self.__options.print_debug("Collected {} udev events in {:.3f}s, next window {:.3f}s"
+                                       .format(len(events), last - first, self.__burst_window))
+        return events
+
+    # Everything from one burst: removals first, since they free up ports, then
+    # additions most urgent first.  A device whose last event was a removal is not attached at all, and
+    # one added more than once is only attached for its latest add, which has its current address.
+    def __order_events(self, devices: List[Device]) -> List[Device]:
+        last_event = {d.sys_name: d for d in devices if d.action in ("add", "remove")}
+        additions = [d for d in last_event.values() if d.action == "add"]
+        return [d for d in devices if d.action != "add"] + self.__priorities.sort(additions)
+
+    # Everything from one burst.  Additions we care about are handed over together, so they can be given
+    # ports in a single pass; a burst with only one of them goes through handle_event like any other.
+    async def handle_events(self, devices: List[Device]) -> None:
+        ordered = self.__order_events(devices)
+        for device in (d for d in ordered if d.action != "add"):
+            await self.handle_event(device)
+
+        additions = [d for d in ordered if d.action == "add"]
+        wanted = [d for d in additions if self.__is_a_device_we_care_about(d)]
+        if len(wanted) < 2:
+            for device in additions:
+                await self.handle_event(device)
+            return
+
+        start = time.monotonic()
+        self.__last_event = start
+        for device in additions:
             self.__options.print_very_verbose('{0.action} on {0.device_path}'.format(device))
-            if device.action == "add":
-                if self.__is_a_device_we_care_about(device):
-                    await self.device_added.fire(device)
-            elif device.action == "remove":
-                await self.device_removed.fire(device)
-
-    def __init__(self, opts: Options, xen_domain: XenDomain):
+            if self.__recorder is not None:
+                self.__recorder.udev(device)
+
+        await self.devices_added.fire(wanted)
+        if self.__recorder is not None:
+            self.__recorder.stage("udev add batch", time.monotonic() - start)
+
+    async def handle_event(self, device: Device) -> None:
+        self.__options.print_very_verbose('{0.action} on {0.device_path}'.format(device))
+        start = time.monotonic()
+        self.__last_event = start
+        if self.__recorder is not None:
+            self.__recorder.udev(device)
+
+        if device.action == "add":
+            if self.__is_a_device_we_care_about(device):
+                await self.device_added.fire(device)
+        elif device.action == "remove":
+            await self.device_removed.fire(device)
+
+        if self.__recorder is not None:
+            self.__recorder.stage("udev {}".format(device.action), time.monotonic() - start)
+
+    def __init__(self, opts: Options, xen_domain: XenDomain, recorder: Optional[TraceRecorder] = None):
         self.__context = pyudev.Context()
         self.__options = opts
         self.__domain = xen_domain
+        self.__recorder = recorder
+        self.__priorities = AttachPriorities(opts)
         self.__root_devices = []
-        self.__specific_devices = []
+        self.__specific_devices: Set[Tuple[str, str]] = set()
         self.__shutdown = False
+        self.__last_event = time.monotonic()
+        self.__readable = asyncio.Event()
+        self.__burst_window = BURST_WINDOW_INITIAL
+        self.__last_burst_end = 0.0
 
         self.device_added = AsyncEvent()
+        self.devices_added = AsyncEvent()
+        self.attach_failed = AsyncEvent()
         self.device_removed = AsyncEvent()
 
     def __repr__(self):
@@ -0,0 +1,32 @@
+from typing import Dict, Optional, Tuple
+
+from .device import Device
+
+DeviceIdentity = Tuple[str, str, str, str]
+
+
+# Remembers which controller and port each physical device last used.
+# Identity is the sysfs port path (the device's sys_name, e.g. "3-1.2") plus its vendor, product and serial,
+# none of which change when the device is reset or re-enumerated, unlike its devnum.
+class SlotMemory:
+    @staticmethod
+    def identity(device: Device) -> DeviceIdentity:
+        return device.sys_name, device.vendor_id, device.product_id, device.serial
+
+    def remember(self, device: Device, controller: int, port: int) -> None:
+        self.__slots[self.identity(device)] = (controller, port)
+
+    def recall(self, device: Device) -> Optional[Tuple[int, int]]:
+        return self.__slots.get(self.identity(device))
+
+    def forget(self, device: Device) -> None:
+        self.__slots.pop(self.identity(device), None)
+
+    def __init__(self):
+        self.__slots: Dict[DeviceIdentity, Tuple[int, int]] = {}
+
+    def __len__(self):
+        return len(self.__slots)
+
+    def __repr__(self):
+        return "SlotMemory({!r})".format(self.__slots)
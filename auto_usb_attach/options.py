@@ -1,9 +1,17 @@
-from typing import List, Optional
+from typing import List, Optional, Dict, Any
 import argparse
 from datetime import datetime
 import os
 import yaml
 
+DEFAULT_CACHE_DIR = "/var/cache/auto-usb-attach"
+# The usb-host properties that can be set from the config file, and the YAML type each one takes
+USB_HOST_PROPERTIES = {"pipeline": bool,
+                       "isobufs": int,
+                       "isobsize": int,
+                       "loglevel": int,
+                       "guest-reset": bool}
+
 
 class Options:
     @property
@@ -50,13 +58,92 @@ class Options:
     def wait_on_shutdown(self) -> bool:
         return self.__wait_on_shutdown
 
+    # None means "pick the controller type from each device's speed"
     @property
-    def usb_version(self) -> int:
+    def usb_version(self) -> Optional[int]:
         return self.__usb_version
 
+    @property
+    def placement_policy(self) -> str:
+        return self.__placement_policy
+
+    @property
+    def max_controllers(self) -> int:
+        return self.__max_controllers
+
+    # Seconds a controller we created has to sit empty before it is removed again (0 to keep them all)
+    @property
+    def controller_grace(self) -> float:
+        return self.__controller_grace
+
+    @property
+    def consolidate_controllers(self) -> bool:
+        return self.__consolidate_controllers
+
+    @property
+    def record_file(self) -> Optional[str]:
+        return self.__record_file
+
+    # When set, only events udev has tagged with this (see --write-udev-rules) are delivered to us
+    @property
+    def udev_tag(self) -> Optional[str]:
+        return self.__udev_tag
+
+    @property
+    def udev_rules_file(self) -> Optional[str]:
+        return self.__udev_rules_file
+
+    @property
+    def plan(self) -> bool:
+        return self.__plan
+
+    @property
+    def profile_dir(self) -> str:
+        return self.__profile_dir or self.__cache_dir
+
+    @property
+    def profile_seconds(self) -> int:
+        return self.__profile_seconds
+
+    @property
+    def slow_callback_ms(self) -> Optional[int]:
+        return self.__slow_callback_ms
+
+    # Attach order by interface class ("hid", "audio", "video", "storage", "hub", "other"), lowest first
+    @property
+    def class_priorities(self) -> Dict[str, int]:
+        return self.__class_priorities
+
+    # Attach order for specific <vendor-id>:<product-id> pairs, overriding their class
+    @property
+    def device_priorities(self) -> Dict[str, int]:
+        return self.__device_priorities
+
+    # Extra usb-host properties by interface class, passed to QEMU when a device is attached
+    @property
+    def usb_host_options(self) -> Dict[str, Optional[Dict[str, Any]]]:
+        return self.__usb_host_options
+
+    # The same for specific <vendor-id>:<product-id> pairs, applied over the class settings
+    @property
+    def device_usb_host_options(self) -> Dict[str, Optional[Dict[str, Any]]]:
+        return self.__device_usb_host_options
+
+    @property
+    def cache_dir(self) -> str:
+        return self.__cache_dir
+
+    @property
+    def daemon(self) -> bool:
+        return self.__daemon
+
+    @property
+    def log_file(self) -> Optional[str]:
+        return self.__log_file
+
     @staticmethod
     def __print_with_timestamp(string: str) -> None:
-        print("[{:%a %b %d %H:%M:%S %Y}] {}".format(datetime.now(), string))
+        print("[{:%a %b %d %H:%M:%S %Y}] {}".format(datetime.now(), string), flush=True)
 
     def print_debug(self, string: str) -> None:
         if self.is_debug:
@@ -92,48 +179,161 @@ class Options:
                             type=str, action="append", dest="specific_device")
         parser.add_argument("-w", "--wait-on-shutdown", help="Wait for a new domain on domain shutdown. (Do not exit)",
                             dest="wait_on_shutdown", action="store_true")
-        parser.add_argument("--usb-version", help="USB Controller version (defaults to 3)", type=int, default=None,
-                            choices=range(1, 4))
+        parser.add_argument("--usb-version", help="USB Controller version, or \"auto\" to match each device's "
+                                                  "speed (defaults to 3)", type=str, default=None,
+                            choices=["1", "2", "3", "auto"])
+        parser.add_argument("--placement", help="Controller placement policy (defaults to pack)", type=str,
+                            default=None, dest="placement_policy", choices=["pack", "spread", "isolate-hid"])
+        parser.add_argument("--max-controllers", help="Maximum controllers the spread policy will create "
+                                                      "(defaults to 4)", type=int, default=None,
+                            dest="max_controllers")
+        parser.add_argument("--controller-grace", help="Remove controllers this script created once they have been "
+                                                       "empty for this many seconds, 0 to never remove them "
+                                                       "(defaults to 300)", type=float, default=None,
+                            dest="controller_grace")
+        parser.add_argument("--consolidate-controllers", help="While nothing is being plugged in, move devices off "
+                                                              "a sparsely used controller so it can be removed",
+                            dest="consolidate_controllers", action="store_true")
+        parser.add_argument("--record", help="Record udev, xenstore and QMP traffic to a trace file", type=str,
+                            default=None, dest="record_file")
+        parser.add_argument("--udev-tag", help="Only listen for udev events carrying this tag", type=str,
+                            default=None, dest="udev_tag")
+        parser.add_argument("--write-udev-rules", help="Write udev rules tagging the watched hubs and devices to a "
+                                                       "file and exit", type=str, default=None,
+                            dest="udev_rules_file")
+        parser.add_argument("--plan", help="Report the attaches, detaches and controllers a startup would need, "
+                                           "then exit without changing anything", action="store_true")
+        parser.add_argument("--profile-dir", help="Where SIGUSR1 profiles and SIGUSR2 memory snapshots are written "
+                                                  "(defaults to the cache directory)", type=str, default=None,
+                            dest="profile_dir")
+        parser.add_argument("--profile-seconds", help="How long a SIGUSR1 profile runs (defaults to 30)", type=int,
+                            default=None, dest="profile_seconds")
+        parser.add_argument("--slow-callback-ms", help="Report anything that blocks the event loop for longer "
+                                                       "than this", type=int, default=None, dest="slow_callback_ms")
+        parser.add_argument("--cache-dir", help="Where discovered QMP capabilities are cached (defaults to "
+                                                "{})".format(DEFAULT_CACHE_DIR), type=str, default=None,
+                            dest="cache_dir")
+        parser.add_argument("-D", "--daemon", help="Run in the background (stays in the foreground under systemd, "
+                                                   "and notifies it once the startup scan is done)",
+                            action="store_true")
+        parser.add_argument("-l", "--log-file", help="Append output to this file instead of stdout", type=str,
+                            default=None, dest="log_file")
 
         return parser
 
     def __load_from_config_file(self, config_file) -> None:
-        config = yaml.safe_load(config_file)
+        self.__load_config(yaml.safe_load(config_file) or {})
+
+    def __load_config(self, config: Dict[str, Any]) -> None:
         self.__domain = config['domain'] if 'domain' in config else None
         self.__qmp_socket = config['qmp-socket'] if 'qmp-socket' in config else None
         self.__no_wait = not config['wait-for-domain'] if 'wait-for-domain' in config else False
         self.__wait_on_shutdown = config['wait-on-shutdown'] if 'wait-on-shutdown' in config else False
         self.__usb_version = config['usb-version'] if 'usb-version' in config else 3
-        self.__hubs = config['hubs'] if 'hubs' in config else []
-        self.__specific_devices = config['devices'] if 'devices' in config else []
-
-    def __init__(self, args: List[str]):
-        self.__wrapper_name = os.environ.get("WRAPPER") or args[0]
-        parser = self.__get_argument_parser()
-        parsed = parser.parse_args(args[1:])
-        self.__verbosity = -1 if parsed.quiet else parsed.verbose
-
-        if parsed.config is not None:
-            self.__load_from_config_file(parsed.config)
+        if self.__usb_version == "auto":
+            self.__usb_version = None
+        self.__hubs = list(config['hubs']) if 'hubs' in config else []
+        self.__specific_devices = list(config['devices']) if 'devices' in config else []
+        self.__placement_policy = config['placement'] if 'placement' in config else "pack"
+        self.__max_controllers = config['max-controllers'] if 'max-controllers' in config else 4
+        self.__controller_grace = config['controller-grace'] if 'controller-grace' in config else 300
+        self.__consolidate_controllers = config['consolidate-controllers'] \
+            if 'consolidate-controllers' in config else False
+        self.__udev_tag = config['udev-tag'] if 'udev-tag' in config else None
+        self.__profile_dir = config['profile-dir'] if 'profile-dir' in config else None
+        self.__profile_seconds = config['profile-seconds'] if 'profile-seconds' in config else 30
+        self.__slow_callback_ms = config['slow-callback-ms'] if 'slow-callback-ms' in config else None
+        self.__class_priorities = config.get('priorities') or {}
+        self.__device_priorities = config.get('device-priorities') or {}
+        self.__usb_host_options = config.get('usb-host-options') or {}
+        self.__device_usb_host_options = config.get('device-usb-host-options') or {}
+        self.__cache_dir = config['cache-dir'] if 'cache-dir' in config else DEFAULT_CACHE_DIR
+        self.__daemon = config['daemon'] if 'daemon' in config else False
+        self.__log_file = config['log-file'] if 'log-file' in config else None
 
+    def __apply_arguments(self, parsed: argparse.Namespace) -> None:
         self.__domain = parsed.domain or self.__domain
         if parsed.hub is not None:
             self.__hubs.extend(parsed.hub)
         self.__qmp_socket = parsed.qmp_socket or self.__qmp_socket
         self.__no_wait = parsed.no_wait if parsed.no_wait else self.__no_wait
-        self.__args = args
         if parsed.specific_device is not None:
             self.__specific_devices.extend(parsed.specific_device)
         self.__wait_on_shutdown = parsed.wait_on_shutdown if parsed.wait_on_shutdown else self.__wait_on_shutdown
-        self.__usb_version = parsed.usb_version or self.__usb_version
+        if parsed.usb_version is not None:
+            self.__usb_version = None if parsed.usb_version == "auto" else int(parsed.usb_version)
+        self.__placement_policy = parsed.placement_policy or self.__placement_policy
+        self.__max_controllers = parsed.max_controllers or self.__max_controllers
+        if parsed.controller_grace is not None:
+            self.__controller_grace = parsed.controller_grace
+        self.__consolidate_controllers = parsed.consolidate_controllers if parsed.consolidate_controllers \
+            else self.__consolidate_controllers
+        self.__record_file = parsed.record_file
+        self.__udev_tag = parsed.udev_tag or self.__udev_tag
+        self.__udev_rules_file = parsed.udev_rules_file
+        self.__plan = parsed.plan
+        self.__profile_dir = parsed.profile_dir or self.__profile_dir
+        self.__profile_seconds = parsed.profile_seconds or self.__profile_seconds
+        self.__slow_callback_ms = parsed.slow_callback_ms or self.__slow_callback_ms
+        self.__cache_dir = parsed.cache_dir or self.__cache_dir
+        self.__daemon = parsed.daemon if parsed.daemon else self.__daemon
+        self.__log_file = parsed.log_file or self.__log_file
+        if self.__log_file is not None:
+            # Daemon mode changes directory to /
+            self.__log_file = os.path.abspath(self.__log_file)
+
+    # Checked up front, since a bad value would otherwise only show up as a device_add error on every attach
+    @staticmethod
+    def __validate_usb_host_options(name: str, entries: Any) -> Optional[str]:
+        if not isinstance(entries, dict):
+            return "{} must be a mapping".format(name)
+
+        for key, properties in entries.items():
+            if not isinstance(properties or {}, dict):
+                return "{} for {} must be a mapping of usb-host options".format(name, key)
+            for option, value in (properties or {}).items():
+                if option not in USB_HOST_PROPERTIES:
+                    return "Unknown usb-host option {} for {}".format(option, key)
+                expected = USB_HOST_PROPERTIES[option]
+                if not isinstance(value, expected) or (expected is int and isinstance(value, bool)):
+                    return "usb-host option {} for {} must be {}".format(option, key, "true or false"
+                                                                        if expected is bool else "a whole number")
+
+        return None
 
+    def __validate(self) -> Optional[str]:
         if self.__domain is None:
-            parser.error("Must specify the domain to watch")
+            return "Must specify the domain to watch"
 
         if len(self.__hubs) == 0 and len(self.__specific_devices) == 0:
-            parser.error("Must specify at least one --hub or --specific-device")
+            return "Must specify at least one --hub or --specific-device"
 
-        self.print_debug("Program name: {}".format(self.__wrapper_name))
+        if self.__usb_version not in (None, 1, 2, 3):
+            return "Unknown usb version {}".format(self.__usb_version)
+
+        if self.__placement_policy not in ("pack", "spread", "isolate-hid"):
+            return "Unknown placement policy {}".format(self.__placement_policy)
+
+        if self.__controller_grace < 0:
+            return "Controller grace period cannot be negative"
+
+        for name, priorities in (("priorities", self.__class_priorities),
+                                 ("device-priorities", self.__device_priorities)):
+            if not isinstance(priorities, dict) or \
+                    not all(isinstance(p, int) and not isinstance(p, bool) for p in priorities.values()):
+                return "{} must map names to whole numbers".format(name)
+
+        error = self.__validate_usb_host_options("usb-host-options", self.__usb_host_options) or \
+            self.__validate_usb_host_options("device-usb-host-options", self.__device_usb_host_options)
+        if error is not None:
+            return error
+
+        if self.__plan and self.__record_file is not None:
+            return "--plan cannot be combined with --record"
+
+        return None
+
+    def __print_settings(self) -> None:
         self.print_unless_quiet("Settings:")
         self.print_unless_quiet("Verbosity: {}".format("Very Verbose" if self.is_very_verbose else
                                                        "Verbose" if self.is_verbose else
@@ -144,6 +344,74 @@ class Options:
         self.print_unless_quiet("Specific Devices: {}".format(self.specific_devices))
         self.print_unless_quiet("Wait on Shutdown: {}".format(self.wait_on_shutdown))
         self.print_unless_quiet("QMP socket: {}".format(self.qmp_socket))
+        self.print_unless_quiet("USB Version: {}".format(self.usb_version or "auto"))
+        self.print_unless_quiet("Placement: {}".format(self.placement_policy))
+        if self.udev_tag is not None:
+            self.print_unless_quiet("udev Tag: {}".format(self.udev_tag))
+
+    # Re-read the config file (command line arguments still take precedence).  The domain and QMP socket
+    # can't change under a running monitor, so those keep their current values.  On any error the
+    # current settings are left alone.
+    def reload(self) -> bool:
+        if self.__config_file is None:
+            self.print_unless_quiet("No config file to reload")
+            return False
+
+        try:
+            with open(self.__config_file) as config_file:
+                config = yaml.safe_load(config_file) or {}
+        except (OSError, yaml.YAMLError) as e:
+            self.print_unless_quiet("Could not reload {}: {}".format(self.__config_file, e))
+            return False
+
+        # Build the new settings on a copy, so nothing changes here unless all of them are good
+        reloaded = Options.__new__(Options)
+        reloaded.__dict__.update(self.__dict__)
+        try:
+            reloaded.__load_config(config)
+            reloaded.__apply_arguments(self.__parsed)
+            error = reloaded.__validate()
+        except (AttributeError, TypeError, ValueError) as e:
+            error = "malformed config ({})".format(e)
+        if error is not None:
+            self.print_unless_quiet("Not reloading {}: {}".format(self.__config_file, error))
+            return False
+
+        if reloaded.__domain != self.__domain:
+            self.print_unless_quiet("Domain cannot be changed without a restart, keeping {}".format(self.__domain))
+        if reloaded.__qmp_socket != self.__qmp_socket:
+            self.print_unless_quiet("QMP socket cannot be changed without a restart, keeping {}"
+                                    .format(self.__qmp_socket))
+        reloaded.__domain = self.__domain
+        reloaded.__qmp_socket = self.__qmp_socket
+        self.__dict__.update(reloaded.__dict__)
+
+        self.print_unless_quiet("Reloaded {}".format(self.__config_file))
+        self.__print_settings()
+        return True
+
+    def __init__(self, args: List[str]):
+        self.__wrapper_name = os.environ.get("WRAPPER") or args[0]
+        parser = self.__get_argument_parser()
+        parsed = parser.parse_args(args[1:])
+        self.__verbosity = -1 if parsed.quiet else parsed.verbose
+        self.__parsed = parsed
+        self.__args = args
+        # Re-read on SIGHUP, by which time daemon mode has changed directory to /
+        self.__config_file = os.path.abspath(parsed.config.name) if parsed.config is not None else None
+
+        if parsed.config is not None:
+            self.__load_from_config_file(parsed.config)
+        else:
+            self.__load_config({})
+
+        self.__apply_arguments(parsed)
+        error = self.__validate()
+        if error is not None:
+            parser.error(error)
+
+        self.print_debug("Program name: {}".format(self.__wrapper_name))
+        self.__print_settings()
 
     def __repr__(self):
         return "Options({!r})".format(self.__args)
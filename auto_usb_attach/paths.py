@@ -0,0 +1,16 @@
+import os
+import stat
+
+
+# A directory only we can write to: created 0700 when it is missing, and refused when it is a symlink,
+# belongs to someone else or can be written by other users
+def private_directory(path: str) -> str:
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode):
+        raise NotADirectoryError("{} is not a directory".format(path))
+    if info.st_uid != os.geteuid():
+        raise PermissionError("{} is not owned by uid {}".format(path, os.geteuid()))
+    if info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise PermissionError("{} is writable by other users".format(path))
+    return path
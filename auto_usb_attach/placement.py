@@ -0,0 +1,242 @@
+import abc
+from typing import Callable, Dict, FrozenSet, List, Optional, Tuple
+
+import pyudev
+
+from .device import Device
+from .options import Options
+
+# USB interface class codes (https://www.usb.org/defined-class-codes)
+INTERFACE_CLASSES = {0x01: "audio",
+                     0x03: "hid",
+                     0x08: "storage",
+                     0x09: "hub",
+                     0x0e: "video"}
+
+ISOCHRONOUS_CLASSES = frozenset(["audio", "video"])
+HIGH_BANDWIDTH_CLASSES = ISOCHRONOUS_CLASSES | frozenset(["storage"])
+
+
+# Map a negotiated speed (Mbit/s, from sysfs) to the controller that emulates it most cheaply:
+# 1.5/12 -> UHCI, 480 -> EHCI, 5000 and above (or unknown) -> xHCI
+def usb_version_for_speed(speed: float) -> int:
+    if 0 < speed <= 12:
+        return 1
+    if speed == 480:
+        return 2
+    return 3
+
+
+class DeviceProfile:
+    @property
+    def sys_name(self) -> str:
+        return self.__sys_name
+
+    @property
+    def classes(self) -> FrozenSet[str]:
+        return self.__classes
+
+    @property
+    def speed(self) -> float:
+        return self.__speed
+
+    @property
+    def is_high_bandwidth(self) -> bool:
+        return len(self.__classes & HIGH_BANDWIDTH_CLASSES) > 0
+
+    @property
+    def is_hid(self) -> bool:
+        return self.__classes == frozenset(["hid"])
+
+    @staticmethod
+    def from_device(device: Device) -> "DeviceProfile":
+        classes = frozenset(INTERFACE_CLASSES.get(c, "other") for c in device.interface_classes)
+        return DeviceProfile(device.sys_name, classes, device.speed)
+
+    def __init__(self, sys_name: str, classes: FrozenSet[str], speed: float):
+        self.__sys_name = sys_name
+        self.__classes = classes
+        self.__speed = speed
+
+    def __repr__(self):
+        return "DeviceProfile({!r}, {!r}, {!r})".format(self.__sys_name, self.__classes, self.__speed)
+
+
+class ControllerState:
+    @property
+    def controller(self) -> int:
+        return self.__controller
+
+    @property
+    def usb_version(self) -> int:
+        return self.__usb_version
+
+    @property
+    def ports(self) -> Dict[int, str]:
+        return self.__ports
+
+    @property
+    def free_ports(self) -> List[int]:
+        return [port for port, sys_name in sorted(self.__ports.items()) if sys_name == ""]
+
+    @property
+    def occupants(self) -> List[str]:
+        return [sys_name for port, sys_name in sorted(self.__ports.items()) if sys_name != ""]
+
+    def __init__(self, controller: int, usb_version: int, ports: Dict[int, str]):
+        self.__controller = controller
+        self.__usb_version = usb_version
+        self.__ports = ports
+
+    def __repr__(self):
+        return "ControllerState({!r}, {!r}, {!r})".format(self.__controller, self.__usb_version, self.__ports)
+
+
+class PlacementPolicy(abc.ABC):
+    name = None
+
+    @abc.abstractmethod
+    def choose(self, profile: DeviceProfile, controllers: List[ControllerState],
+               occupant_profile: Callable[[str], DeviceProfile]) -> Optional[Tuple[int, int]]:
+        pass
+
+    @staticmethod
+    def _first_free(controllers: List[ControllerState]) -> Optional[Tuple[int, int]]:
+        for state in controllers:
+            if len(state.free_ports) > 0:
+                return state.controller, state.free_ports[0]
+        return None
+
+    def __repr__(self):
+        return "{}()".format(type(self).__name__)
+
+
+# Fill the lowest-numbered controller first, keeping the controller count down.
+class PackPolicy(PlacementPolicy):
+    name = "pack"
+
+    def choose(self, profile: DeviceProfile, controllers: List[ControllerState],
+               occupant_profile: Callable[[str], DeviceProfile]) -> Optional[Tuple[int, int]]:
+        return self._first_free(controllers)
+
+
+# Give every high-bandwidth device its own emulated controller while we are under max_controllers,
+# and keep everything else off the controllers those devices occupy.
+class SpreadPolicy(PlacementPolicy):
+    name = "spread"
+
+    def choose(self, profile: DeviceProfile, controllers: List[ControllerState],
+               occupant_profile: Callable[[str], DeviceProfile]) -> Optional[Tuple[int, int]]:
+        def heavy_count(state: ControllerState) -> int:
+            return len([o for o in state.occupants if occupant_profile(o).is_high_bandwidth])
+
+        candidates = sorted((s for s in controllers if len(s.free_ports) > 0),
+                            key=lambda s: (heavy_count(s), s.controller))
+        if len(candidates) == 0:
+            return None
+
+        best = candidates[0]
+        if heavy_count(best) > 0 and len(controllers) < self.__max_controllers:
+            return None
+        return best.controller, best.free_ports[0]
+
+    def __init__(self, max_controllers: int):
+        self.__max_controllers = max_controllers
+
+    def __repr__(self):
+        return "SpreadPolicy({!r})".format(self.__max_controllers)
+
+
+# Keep HID-only devices together on one controller that nothing else shares.
+class IsolateHidPolicy(PlacementPolicy):
+    name = "isolate-hid"
+
+    def choose(self, profile: DeviceProfile, controllers: List[ControllerState],
+               occupant_profile: Callable[[str], DeviceProfile]) -> Optional[Tuple[int, int]]:
+        def is_hid_controller(state: ControllerState) -> bool:
+            return len(state.occupants) > 0 and all(occupant_profile(o).is_hid for o in state.occupants)
+
+        if profile.is_hid:
+            hid_controllers = [s for s in controllers if is_hid_controller(s)]
+            if len(hid_controllers) > 0:
+                return self._first_free(hid_controllers)
+            return self._first_free([s for s in controllers if len(s.occupants) == 0])
+
+        return self._first_free([s for s in controllers if not is_hid_controller(s)])
+
+
+class Placement:
+    def __get_policy(self) -> PlacementPolicy:
+        if self.__options.placement_policy == SpreadPolicy.name:
+            return SpreadPolicy(self.__options.max_controllers)
+        if self.__options.placement_policy == IsolateHidPolicy.name:
+            return IsolateHidPolicy()
+        return PackPolicy()
+
+    # The options can change under us on a config reload
+    def __current_policy(self) -> PlacementPolicy:
+        key = (self.__options.placement_policy, self.__options.max_controllers)
+        if key != self.__policy_key:
+            self.__policy = self.__get_policy()
+            self.__policy_key = key
+        return self.__policy
+
+    def profile(self, device: Device) -> DeviceProfile:
+        profile = DeviceProfile.from_device(device)
+        self.__profiles[device.sys_name] = profile
+        return profile
+
+    def __occupant_profile(self, sys_name: str) -> DeviceProfile:
+        if sys_name not in self.__profiles:
+            if self.__context is None:
+                self.__context = pyudev.Context()
+            device = Device.from_sys_name(self.__context, sys_name)
+            self.__profiles[sys_name] = DeviceProfile.from_device(device) if device is not None \
+                else DeviceProfile(sys_name, frozenset(), 0)
+        return self.__profiles[sys_name]
+
+    def controller_version(self, device: Device) -> int:
+        return self.__options.usb_version or usb_version_for_speed(device.speed)
+
+    # With speed matching, only controllers of the device's own type are candidates,
+    # so each controller type keeps its own pool
+    def choose(self, device: Device, controllers: List[ControllerState]) -> Optional[Tuple[int, int]]:
+        profile = self.profile(device)
+        usb_version = self.controller_version(device)
+        matching = self.__options.usb_version is None
+        pool = sorted((s for s in controllers if not matching or s.usb_version == usb_version),
+                      key=lambda s: s.controller)
+        policy = self.__current_policy()
+        choice = policy.choose(profile, pool, self.__occupant_profile)
+        self.__options.print_debug("{!r} placed {!r} at {!r}".format(policy, profile, choice))
+        return choice
+
+    # Where every occupant of one controller could go instead, if the policy would put all of them
+    # on the other controllers; None if any of them would still need a controller of its own
+    def relocate(self, controller: ControllerState,
+                 controllers: List[ControllerState]) -> Optional[List[Tuple[Device, int, int]]]:
+        if self.__context is None:
+            self.__context = pyudev.Context()
+
+        others = [ControllerState(s.controller, s.usb_version, dict(s.ports)) for s in controllers
+                  if s.controller != controller.controller]
+        moves = []
+        for sys_name in controller.occupants:
+            device = Device.from_sys_name(self.__context, sys_name)
+            choice = self.choose(device, others) if device is not None else None
+            if choice is None:
+                return None
+            next(s for s in others if s.controller == choice[0]).ports[choice[1]] = sys_name
+            moves.append((device, choice[0], choice[1]))
+
+        return moves
+
+    def __init__(self, options: Options):
+        self.__options = options
+        self.__context = None
+        self.__profiles: Dict[str, DeviceProfile] = {}
+        self.__policy = None
+        self.__policy_key = None
+
+    def __repr__(self):
+        return "Placement({!r})".format(self.__options)
@@ -0,0 +1,90 @@
+from typing import Dict, List, Optional
+
+
+class PlannedAction:
+    @property
+    def kind(self) -> str:
+        return self.__kind
+
+    @property
+    def description(self) -> str:
+        return self.__description
+
+    @property
+    def xenstore_round_trips(self) -> int:
+        return self.__xenstore_round_trips
+
+    @property
+    def qmp_round_trips(self) -> int:
+        return self.__qmp_round_trips
+
+    def __init__(self, kind: str, description: str, xenstore_round_trips: int, qmp_round_trips: int):
+        self.__kind = kind
+        self.__description = description
+        self.__xenstore_round_trips = xenstore_round_trips
+        self.__qmp_round_trips = qmp_round_trips
+
+    def __repr__(self):
+        return "PlannedAction({!r}, {!r}, {!r}, {!r})".format(self.__kind, self.__description,
+                                                              self.__xenstore_round_trips, self.__qmp_round_trips)
+
+
+# What a dry run would have changed.  Writes are kept here instead of going to xenstore,
+# so later decisions in the same run see the controllers and ports earlier ones took.
+class Plan:
+    @property
+    def actions(self) -> List[PlannedAction]:
+        return self.__actions
+
+    @property
+    def xenstore(self) -> Dict[str, str]:
+        return self.__xenstore
+
+    def add(self, kind: str, description: str, xs_writes: Dict[str, str], qmp_round_trips: int) -> None:
+        self.__xenstore.update(xs_writes)
+        # transaction start and commit, plus one write per entry
+        self.__actions.append(PlannedAction(kind, description, len(xs_writes) + 2, qmp_round_trips))
+
+    @staticmethod
+    def __mean(stages: Dict[str, List[float]], prefix: str) -> float:
+        samples = [s for name, values in stages.items() if name.startswith(prefix) for s in values]
+        return sum(samples) / len(samples) if len(samples) > 0 else 0.0
+
+    # Reads were really made while planning, so their latencies stand in for the writes and commands
+    # that weren't.  The estimate assumes every round trip is made one after another.
+    def report(self, domain: str, domain_id: Optional[int], stages: Dict[str, List[float]]) -> str:
+        xs_mean = self.__mean(stages, "xenstore ")
+        qmp_mean = self.__mean(stages, "qmp ")
+        xs_reads = sum(len(v) for name, v in stages.items() if name.startswith("xenstore "))
+        qmp_reads = sum(len(v) for name, v in stages.items() if name.startswith("qmp "))
+
+        def estimate(xs: int, qmp: int) -> float:
+            return 1000 * (xs * xs_mean + qmp * qmp_mean)
+
+        lines = ["Plan for domain {} (id {}):".format(domain, domain_id)]
+        for action in self.__actions:
+            lines.append("  {:<8} {:<48} xenstore {:>3}  qmp {:>2}  ~{:>8.2f} ms"
+                         .format(action.kind, action.description, action.xenstore_round_trips,
+                                 action.qmp_round_trips,
+                                 estimate(action.xenstore_round_trips, action.qmp_round_trips)))
+        if len(self.__actions) == 0:
+            lines.append("  Nothing to do")
+
+        xs_total = sum(a.xenstore_round_trips for a in self.__actions)
+        qmp_total = sum(a.qmp_round_trips for a in self.__actions)
+        for kind in ("create", "attach", "detach"):
+            count = len([a for a in self.__actions if a.kind == kind])
+            if count > 0:
+                lines.append("{} {}".format(count, kind))
+        lines.append("Reading current state: xenstore {}, qmp {} round trips ({:.2f} ms)"
+                     .format(xs_reads, qmp_reads, estimate(xs_reads, qmp_reads)))
+        lines.append("Applying the plan: xenstore {}, qmp {} round trips (~{:.2f} ms)"
+                     .format(xs_total, qmp_total, estimate(xs_total, qmp_total)))
+        return "\n".join(lines)
+
+    def __init__(self):
+        self.__actions: List[PlannedAction] = []
+        self.__xenstore: Dict[str, str] = {}
+
+    def __repr__(self):
+        return "Plan({!r})".format(self.__actions)
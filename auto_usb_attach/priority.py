@@ -0,0 +1,34 @@
+from typing import Iterable, List
+
+from .device import Device
+from .options import Options
+from .placement import DeviceProfile
+
+# Lower runs first.  Input devices should be usable before anything that takes a while to attach.
+DEFAULT_CLASS_PRIORITIES = {"hid": 0,
+                            "audio": 1,
+                            "video": 2,
+                            "other": 3,
+                            "storage": 4,
+                            "hub": 5}
+
+
+class AttachPriorities:
+    # A vendor:product priority wins; otherwise a composite device goes by its most urgent interface
+    def priority(self, device: Device) -> int:
+        device_id = "{}:{}".format(device.vendor_id, device.product_id)
+        if device_id in self.__options.device_priorities:
+            return self.__options.device_priorities[device_id]
+
+        classes = DeviceProfile.from_device(device).classes or frozenset(["other"])
+        priorities = dict(DEFAULT_CLASS_PRIORITIES, **self.__options.class_priorities)
+        return min(priorities.get(c, priorities["other"]) for c in classes)
+
+    def sort(self, devices: Iterable[Device]) -> List[Device]:
+        return sorted(devices, key=self.priority)
+
+    def __init__(self, options: Options):
+        self.__options = options
+
+    def __repr__(self):
+        return "AttachPriorities({!r})".format(self.__options)
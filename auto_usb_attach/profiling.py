@@ -0,0 +1,131 @@
+import asyncio
+import cProfile
+import logging
+import marshal
+import os
+import pstats
+import signal
+import time
+import tracemalloc
+from typing import Optional
+
+from .options import Options
+from .paths import private_directory
+
+TOP_N = 30
+TRACEMALLOC_FRAMES = 10
+# Used for the slow callback report during a profiling window when no threshold is configured
+DEFAULT_SLOW_CALLBACK_MS = 100
+
+
+# asyncio reports slow callbacks through logging; send them to the same place as everything else
+class LoopLogHandler(logging.Handler):
+    def emit(self, record: logging.LogRecord) -> None:
+        self.__options.print_unless_quiet("asyncio: {}".format(record.getMessage()))
+
+    def __init__(self, options: Options):
+        super().__init__(logging.WARNING)
+        self.__options = options
+
+    def __repr__(self):
+        return "LoopLogHandler({!r})".format(self.__options)
+
+
+# SIGUSR1: profile the event loop for profile-seconds and write the stats (plus a readable summary).
+# SIGUSR2: the first one starts tracing allocations, each later one writes the top allocation sites
+#          and what grew since tracing started.
+# With slow-callback-ms, any callback or task step that holds the loop longer than that is reported,
+# naming the coroutine it was running.
+class Profiler:
+    def __output_path(self, kind: str) -> str:
+        return os.path.join(private_directory(self.__options.profile_dir), "auto-usb-attach-{}-{}-{}"
+                            .format(os.getpid(), kind, time.strftime("%Y%m%d-%H%M%S")))
+
+    # We run as root, so never follow or reuse anything already sitting at the path
+    @staticmethod
+    def __create(path: str, mode: str):
+        return os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600), mode)
+
+    def __report_slow_callbacks(self, threshold_ms: Optional[int]) -> None:
+        self.__loop.set_debug(threshold_ms is not None)
+        if threshold_ms is not None:
+            self.__loop.slow_callback_duration = threshold_ms / 1000
+
+    def __start_profile(self) -> None:
+        if self.__profile_task is not None and not self.__profile_task.done():
+            self.__options.print_unless_quiet("Already profiling")
+            return
+        self.__profile_task = asyncio.ensure_future(self.__profile_window())
+
+    async def __profile_window(self) -> None:
+        seconds = self.__options.profile_seconds
+        self.__options.print_unless_quiet("Profiling for {}s".format(seconds))
+        self.__report_slow_callbacks(self.__options.slow_callback_ms or DEFAULT_SLOW_CALLBACK_MS)
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profile.disable()
+            self.__report_slow_callbacks(self.__options.slow_callback_ms)
+
+        try:
+            path = self.__output_path("profile")
+            profile.create_stats()
+            with self.__create(path + ".prof", "wb") as stats:
+                marshal.dump(profile.stats, stats)
+            with self.__create(path + ".txt", "w") as summary:
+                pstats.Stats(profile, stream=summary).sort_stats("cumulative").print_stats(TOP_N)
+        except OSError as e:
+            self.__options.print_unless_quiet("Could not write profile: {}".format(e))
+            return
+        self.__options.print_unless_quiet("Wrote profile to {}".format(path))
+
+    def __snapshot_memory(self) -> None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self.__baseline = tracemalloc.take_snapshot()
+            self.__options.print_unless_quiet("Tracing allocations, send SIGUSR2 again for a snapshot")
+            return
+
+        ignore = (tracemalloc.Filter(False, tracemalloc.__file__),
+                  tracemalloc.Filter(False, "<frozen importlib._bootstrap>"))
+        snapshot = tracemalloc.take_snapshot().filter_traces(ignore)
+        current, peak = tracemalloc.get_traced_memory()
+        try:
+            path = self.__output_path("memory") + ".txt"
+            with self.__create(path, "w") as report:
+                report.write("Traced: {} KiB, peak {} KiB\n\nTop {} allocation sites:\n"
+                             .format(current // 1024, peak // 1024, TOP_N))
+                for stat in snapshot.statistics("lineno")[:TOP_N]:
+                    report.write("{}\n".format(stat))
+                report.write("\nTop {} changes since tracing started:\n".format(TOP_N))
+                for stat in snapshot.compare_to(self.__baseline.filter_traces(ignore), "lineno")[:TOP_N]:
+                    report.write("{}\n".format(stat))
+        except OSError as e:
+            self.__options.print_unless_quiet("Could not write memory snapshot: {}".format(e))
+            return
+        self.__options.print_unless_quiet("Wrote memory snapshot to {}".format(path))
+
+    def install(self) -> None:
+        self.__loop.add_signal_handler(signal.SIGUSR1, self.__start_profile)
+        self.__loop.add_signal_handler(signal.SIGUSR2, self.__snapshot_memory)
+        logging.getLogger("asyncio").addHandler(self.__log_handler)
+        self.__report_slow_callbacks(self.__options.slow_callback_ms)
+
+    def uninstall(self) -> None:
+        self.__loop.remove_signal_handler(signal.SIGUSR1)
+        self.__loop.remove_signal_handler(signal.SIGUSR2)
+        logging.getLogger("asyncio").removeHandler(self.__log_handler)
+        if self.__profile_task is not None:
+            self.__profile_task.cancel()
+
+    def __init__(self, options: Options):
+        self.__options = options
+        self.__loop = asyncio.get_event_loop()
+        self.__log_handler = LoopLogHandler(options)
+        self.__profile_task = None
+        self.__baseline = None
+
+    def __repr__(self):
+        return "Profiler({!r})".format(self.__options)
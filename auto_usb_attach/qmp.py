@@ -1,65 +1,168 @@
 import json
+import re
+import time
 import asyncio
-from typing import Dict, Optional, cast, Iterable, Any
-from collections import AsyncIterable
+from typing import Dict, List, Optional, cast, Iterable, Any, AsyncIterable
 
-from .prioritydict import PriorityDict
+from .capabilities import QmpCapabilities, SEED_FILE
 from .options import Options
 from .xenusb import XenUsb
 from .asyncevent import AsyncEvent
+from .retry import RetryScheduler, RetryPolicy
+from .trace import TraceRecorder
+
+DEVICE_EVENTS = ("DEVICE_DELETED", "DEVICE_UNPLUG_GUEST_ERROR")
+DEVICE_DELETED_TIMEOUT = 10.0
+SOCKET_RETRY_POLICY = RetryPolicy(initial_delay=0.05, max_delay=5.0)
+CONNECT_TIMEOUT = 5.0
+COMMAND_TIMEOUT = 5.0
+# How often the dedicated socket checks that QEMU is still answering, and how long it waits
+WATCHDOG_INTERVAL = 5.0
+WATCHDOG_TIMEOUT = 2.0
+# What we need to know about each usb-host device
+HOST_PROPERTIES = ("parent_bus", "port", "hostbus", "hostaddr")
 
 
 class QmpSocket:
     async def __connect_to_qmp(self) -> Dict[str, Any]:
         if not self.__connected:
-            with (await self.__connect_lock):
+            async with self.__connect_lock:
                 if self.__connected:
                     return self.__connect_info
                 self.__options.print_very_verbose("Connecting to QMP")
                 self.__reader, self.__writer = await asyncio.open_unix_connection(self.__path)
-                self.__connect_info = await self.__receive_line()
-                if self.__connect_info is None or "error" in self.__connect_info:
-                    raise QmpError(self.__connect_info or {"error": "EOF"})
-                await self.__send_line(json.dumps({"execute": "qmp_capabilities"}))
-                data = await self.__receive_line()
-                self.__options.print_very_verbose("{!r}".format(data))
+                try:
+                    await asyncio.wait_for(self.__negotiate(), CONNECT_TIMEOUT)
+                except asyncio.TimeoutError:
+                    self.__drop_connection()
+                    raise QmpError({"class": "Timeout",
+                                    "desc": "No QMP greeting after {}s".format(CONNECT_TIMEOUT)})
+                except QmpError:
+                    self.__drop_connection()
+                    raise
                 self.__connect_event.set()
                 self.__connected = True
 
         return self.__connect_info
 
+    async def greeting(self) -> Dict[str, Any]:
+        return await self.__connect_to_qmp()
+
+    async def __negotiate(self) -> None:
+        self.__connect_info = await self.__receive_line()
+        if self.__connect_info is None or "error" in self.__connect_info:
+            raise QmpError((self.__connect_info or {}).get("error", {"class": "EOF", "desc": "Connection closed"}))
+        await self.__send_line(json.dumps({"execute": "qmp_capabilities"}))
+        data = await self.__receive_line()
+        self.__options.print_very_verbose("{!r}".format(data))
+
+    def __drop_connection(self) -> None:
+        if self.__writer is not None:
+            self.__writer.close()
+        self.__writer = None
+        self.__reader = None
+        self.__connected = False
+
     async def __send_line(self, data: str):
         self.__options.print_very_verbose(data)
+        if self.__writer is None:
+            raise QmpError({"class": "EOF", "desc": "Connection closed"})
+        if self.__recorder is not None:
+            self.__recorder.qmp(self.__path, "out", data)
         self.__writer.write(bytes(data, "utf-8"))
 
-    async def send(self, data: str) -> Dict[str, Any]:
+    # Every command carries its own id, so a reply that turns up after its caller gave up
+    # is dropped instead of being handed to whoever asked next
+    async def send(self, command: str, arguments: Optional[Dict[str, Any]] = None,
+                   timeout: float = COMMAND_TIMEOUT) -> Dict[str, Any]:
+        if self.__unresponsive and command != "query-status":
+            raise QmpError({"class": "Unresponsive", "desc": "QEMU is not responding, not sending {}".format(command)})
+
+        start = time.monotonic()
         await self.__connect_to_qmp()
-        await self.__send_line(data)
 
-        return await self.__receive_response()
+        self.__next_id += 1
+        command_id = "auto-usb-attach-{}".format(self.__next_id)
+        message = {"execute": command, "id": command_id}
+        if arguments is not None:
+            message["arguments"] = arguments
+
+        try:
+            response = await asyncio.wait_for(self.__exchange(command_id, json.dumps(message)), timeout)
+        except asyncio.TimeoutError:
+            self.__options.print_verbose("No response to QMP {} after {}s".format(command, timeout))
+            if not self.__monitoring:
+                # Whatever is still on the wire belongs to a command nobody is waiting for
+                self.__drop_connection()
+            raise QmpError({"class": "Timeout", "desc": "No response to {} after {}s".format(command, timeout)})
+        finally:
+            self.__responses.pop(command_id, None)
 
-    async def __receive_response(self):
+        if self.__recorder is not None:
+            self.__recorder.stage("qmp {}".format(command), time.monotonic() - start)
+        return response
+
+    async def __exchange(self, command_id: str, line: str) -> Dict[str, Any]:
         if self.__monitoring:
-            self.__options.print_debug("Getting record from queue")
-            with (await self.__response_available):
-                await self.__response_available.wait()
-                data = (await self.__monitor_queue.get()).data
-                self.__monitor_queue.task_done()
-                self.__options.print_very_verbose("{!r}".format(data))
-        else:
-            data = await self.__receive_line()
-            if data is None:
-                raise QmpError({"error": "EOF"})
+            response = asyncio.get_event_loop().create_future()
+            self.__responses[command_id] = response
+            await self.__send_line(line)
+            data = await response
             self.__options.print_very_verbose("{!r}".format(data))
+            return data
 
-        return data
+        async with self.__exchange_lock:
+            # Whoever held the lock before us may have dropped a connection that stopped answering
+            await self.__connect_to_qmp()
+            await self.__send_line(line)
+            while True:
+                data = await self.__receive_line()
+                if data is None:
+                    raise QmpError({"class": "EOF", "desc": "Connection closed"})
+                if "event" in data:
+                    await self.__handle_event(data)
+                elif data.get("id") == command_id:
+                    self.__options.print_very_verbose("{!r}".format(data))
+                    return data
+                else:
+                    self.__options.print_debug("Dropping stale QMP reply {!r}".format(data))
+
+    def __fail_pending(self, error: Exception) -> None:
+        for response in self.__responses.values():
+            if not response.done():
+                response.set_exception(error)
+        self.__responses.clear()
+
+    # A wedged device model stops answering without closing the socket.  Probe it with something cheap,
+    # and while it is stuck fail commands straight away so callers can back off and retry.
+    async def __watchdog(self) -> None:
+        while True:
+            await asyncio.sleep(WATCHDOG_INTERVAL)
+            try:
+                status = await self.send("query-status", timeout=WATCHDOG_TIMEOUT)
+            except QmpError as e:
+                if not self.__unresponsive:
+                    self.__options.print_unless_quiet("QEMU is not responding ({}), failing QMP commands until it "
+                                                      "recovers".format(e))
+                    self.__unresponsive = True
+                    self.__fail_pending(QmpError({"class": "Unresponsive", "desc": "QEMU stopped responding"}))
+                continue
+
+            if self.__unresponsive:
+                self.__options.print_unless_quiet("QEMU is responding again")
+                self.__unresponsive = False
+            self.__options.print_debug("QEMU status: {}".format(status.get("return", {}).get("status")))
 
     async def __receive_line(self) -> Optional[Dict[str, Any]]:
+        if self.__reader is None:
+            return None
         data = await self.__reader.readline()
         if len(data) == 0:
             return None
         data = str(data, "utf-8")
         self.__options.print_debug(data)
+        if self.__recorder is not None:
+            self.__recorder.qmp(self.__path, "in", data.rstrip("\n"))
         return json.loads(data)
 
     async def __handle_event(self, data: Dict[str, Any]):
@@ -68,39 +171,91 @@ class QmpSocket:
                 await self.__domain_reboot.fire()
             elif data["event"] == "SHUTDOWN":
                 await self.__domain_shutdown.fire()
+            elif data["event"] in DEVICE_EVENTS:
+                self.__complete_device_waiter(data)
+
+    def __complete_device_waiter(self, data: Dict[str, Any]) -> None:
+        device_id = data.get("data", {}).get("device")
+        waiter = self.__device_waiters.pop(device_id, None)
+        if waiter is None or waiter.done():
+            return
+
+        if data["event"] == "DEVICE_DELETED":
+            waiter.set_result(data)
+        else:
+            waiter.set_exception(QmpError({"class": data["event"],
+                                           "desc": "Guest refused to release {}".format(device_id)}))
+
+    def expect_device_deleted(self, device_id: str) -> asyncio.Future:
+        waiter = asyncio.get_event_loop().create_future()
+        self.__device_waiters[device_id] = waiter
+        return waiter
+
+    def forget_device_waiter(self, device_id: str) -> None:
+        self.__device_waiters.pop(device_id, None)
+
+    async def wait_for_device_deleted(self, device_id: str, waiter: asyncio.Future, timeout: float) -> None:
+        try:
+            if self.__monitoring:
+                await asyncio.wait_for(asyncio.shield(waiter), timeout)
+                return
+
+            # Nobody else is reading this socket, so pump events until the one we want turns up.  Other
+            # commands wait for the lock meanwhile, and any events they read on the way complete the waiter.
+            deadline = asyncio.get_event_loop().time() + timeout
+            async with self.__exchange_lock:
+                while not waiter.done():
+                    remaining = deadline - asyncio.get_event_loop().time()
+                    if remaining <= 0:
+                        raise asyncio.TimeoutError()
+                    data = await asyncio.wait_for(self.__receive_line(), remaining)
+                    if data is None:
+                        raise QmpError({"class": "EOF", "desc": "Connection closed"})
+                    await self.__handle_event(data)
+            waiter.result()
+        except asyncio.TimeoutError:
+            raise QmpError({"class": "Timeout", "desc": "No DEVICE_DELETED for {} after {}s".format(device_id,
+                                                                                                  timeout)})
 
     def close(self):
         self.__keep_open = False
-        self.__exit__()
+        if self.__connected:
+            self.__drop_connection()
 
     async def monitor(self):
         if self.__monitoring:
             raise QmpError({"error": "Already monitoring"})
 
+        watchdog = None
         try:
             self.__monitoring = True
-            self.__monitor_queue = asyncio.PriorityQueue()
             self.__options.print_debug("Connecting to QMP inside of monitor()")
             await self.__connect_to_qmp()
+            watchdog = asyncio.ensure_future(self.__watchdog())
             while True:
                 data = await self.__receive_line()
                 if data is None:
                     return
-                priority = 0 if "error" in data else 1 if "return" in data else 2
-                self.__options.print_debug("Using priority {}".format(priority))
-                if priority < 2:
-                    await self.__monitor_queue.put(PriorityDict(priority, data))
-                    with (await self.__response_available):
-                        self.__response_available.notify()
-                else:
+                if "event" in data:
                     await self.__handle_event(data)
+                    continue
+
+                response = self.__responses.pop(data.get("id"), None)
+                if response is None or response.done():
+                    self.__options.print_debug("Dropping QMP reply nobody is waiting for: {!r}".format(data))
+                    continue
+                response.set_result(data)
         finally:
+            if watchdog is not None:
+                watchdog.cancel()
             self.__monitoring = False
-            self.__monitor_queue = None
+            self.__unresponsive = False
+            self.__fail_pending(QmpError({"class": "EOF", "desc": "Connection closed"}))
 
     def __init__(self, options: Options, path: str, keep_open: bool, domain_reboot: AsyncEvent,
-                 domain_shutdown: AsyncEvent, connect_event: asyncio.Event):
+                 domain_shutdown: AsyncEvent, connect_event: asyncio.Event, recorder: Optional[TraceRecorder] = None):
         self.__options = options
+        self.__recorder = recorder
         self.__path = path
         self.__keep_open = keep_open
         self.__connected = False
@@ -108,26 +263,37 @@ class QmpSocket:
         self.__writer = None
         self.__connect_info = {}
         self.__monitoring = False
-        self.__monitor_queue = None
+        self.__unresponsive = False
+        self.__next_id = 0
+        self.__responses: Dict[str, asyncio.Future] = {}
         self.__connect_lock = asyncio.Lock()
-        self.__response_available = asyncio.Condition()
+        self.__exchange_lock = asyncio.Lock()
         self.__domain_reboot = domain_reboot
         self.__domain_shutdown = domain_shutdown
         self.__connect_event = connect_event
+        self.__device_waiters: Dict[str, asyncio.Future] = {}
+        self.__users = 0
+        self.__failed = False
 
     def __repr__(self):
         return "QmpSocket({!r}, {!r}, {!r}, {!r})".format(self.__options, self.__path, self.__domain_reboot,
                                                           self.__domain_shutdown)
 
+    # Concurrent commands share the connection, so it is only dropped once the last of them is done with it
     def __enter__(self):
+        self.__users += 1
         return self
 
     def __exit__(self, exc_type=None, exc_val=None, exc_tb=None):
-        if (not self.__keep_open or exc_type is not None) and self.__connected:
-            self.__writer.close()
-            self.__writer = None
-            self.__reader = None
-            self.__connected = False
+        self.__users -= 1
+        self.__failed = self.__failed or exc_type is not None
+        if self.__users > 0:
+            return
+
+        # The monitor loop owns the connection while it is running
+        if (not self.__keep_open or self.__failed) and self.__connected and not self.__monitoring:
+            self.__drop_connection()
+        self.__failed = False
 
 
 # The C++ code to do this in xl can be found at:
@@ -151,12 +317,12 @@ class Qmp:
         self.__qmp_socket = self.__qmp_socket or \
                             QmpSocket(self.__options, self.__path, self.__options.qmp_socket is not None,
                                       self.domain_reboot,
-                                      self.domain_shutdown, self.__connected_event)
+                                      self.domain_shutdown, self.__connected_event, self.__recorder)
         return self.__qmp_socket
 
     @staticmethod
     async def __send_qmp_command(sock: QmpSocket, command: str, arguments: Dict[str, str]) -> Dict[str, Any]:
-        return await sock.send(json.dumps({"execute": command, "arguments": arguments}))
+        return await sock.send(command, arguments)
 
     async def __qom_list(self, sock: QmpSocket, path: str) -> Iterable[Dict[str, str]]:
         result = await self.__send_qmp_command(sock, "qom-list", {"path": path})
@@ -172,16 +338,59 @@ class Qmp:
 
         return result["return"]
 
-    async def __get_usb_controller_ids(self, sock: QmpSocket) -> AsyncIterable:
-        controllers = await self.__qom_list(sock, "peripheral")
-        if controllers is None:
-            return
+    # Discovered once per QEMU build; a reconnect to the same build reuses what we already know
+    async def __get_capabilities(self, sock: QmpSocket) -> QmpCapabilities:
+        version = QmpCapabilities.version_from_greeting(await sock.greeting())
+        if self.__capabilities is not None and self.__capabilities.version == version:
+            return self.__capabilities
+
+        capabilities = QmpCapabilities.load(self.__options, version)
+        if capabilities is None:
+            result = await sock.send("query-commands")
+            if "error" in result or not isinstance(result["return"], list):
+                self.__options.print_verbose("query-commands failed, assuming the commands in {}".format(SEED_FILE))
+                capabilities = QmpCapabilities.seed(version)
+            else:
+                capabilities = QmpCapabilities(version, (c["name"] for c in result["return"]))
+                capabilities.save(self.__options)
+
+        self.__options.print_very_verbose("QEMU {}: {!r}".format(version, capabilities))
+        self.__capabilities = capabilities
+        return capabilities
+
+    @staticmethod
+    def __to_xen_usb(properties: Dict[str, Any]) -> Optional[XenUsb]:
+        # Only devices plugged into one of our controllers (bus "xenusb-N.0")
+        match = re.search(r"xenusb-(\d+)\.\d+$", properties.get("parent_bus") or "")
+        if match is None or properties.get("port") is None:
+            return None
+        return XenUsb(int(match.group(1)), int(properties["port"]), int(properties["hostbus"]),
+                      int(properties["hostaddr"]))
+
+    async def __get_host_properties(self, sock: QmpSocket, path: str) -> Dict[str, Any]:
+        values = await asyncio.gather(*(self.__qom_get(sock, path, name) for name in HOST_PROPERTIES))
+        return dict(zip(HOST_PROPERTIES, values))
+
+    # Every usb-host is a child of /machine/peripheral, so one listing finds them all.  QEMU builds with
+    # qom-list-get return all of their properties in one more round trip; otherwise the qom-gets are
+    # sent together rather than walking each controller's bus one link at a time.
+    async def __get_usb_hosts(self, sock: QmpSocket) -> List[XenUsb]:
+        capabilities = await self.__get_capabilities(sock)
+        peripherals = await self.__qom_list(sock, "peripheral") or []
+        paths = ["/machine/peripheral/{}".format(p["name"]) for p in peripherals
+                 if cast(str, p["type"]) == "child<usb-host>"]
+        if len(paths) == 0:
+            return []
+
+        if capabilities.has("qom-list-get"):
+            result = await self.__send_qmp_command(sock, "qom-list-get", {"paths": paths})
+            if "error" in result:
+                raise QmpError(result["error"])
+            properties = [{p["name"]: p.get("value") for p in o["properties"]} for o in result["return"]]
+        else:
+            properties = await asyncio.gather(*(self.__get_host_properties(sock, path) for path in paths))
 
-        controller_types = {"child<piix3-usb-uhci>": 1,
-                            "child<usb-ehci>": 2,
-                            "child<nec-usb-xhci>": 3}
-        for dev in (d for d in controllers if cast(str, d["type"]) in controller_types):
-            yield int(cast(str, dev["name"]).split("-")[1])
+        return [u for u in (self.__to_xen_usb(p) for p in properties) if u is not None]
 
     async def __get_usb_devices(self, sock: QmpSocket, controller: int) -> AsyncIterable:
         controller_devices = await self.__qom_list(sock, "xenusb-{}.0".format(controller))
@@ -202,31 +411,49 @@ class Qmp:
 
             yield XenUsb(controller, int(port), int(hostbus), int(hostaddr))
 
-    async def attach_usb_device(self, busnum: int, devnum: int, controller: int, port: int) -> None:
+    # tuning holds any extra usb-host properties (pipeline, isobufs, isobsize, loglevel, guest-reset)
+    async def attach_usb_device(self, busnum: int, devnum: int, controller: int, port: int,
+                                tuning: Optional[Dict[str, str]] = None) -> None:
+        qmp_arguments = dict(tuning or {})
+        qmp_arguments.update({"id": "xenusb-{}-{}".format(busnum, devnum),
+                              "driver": "usb-host",
+                              "bus": "xenusb-{}.0".format(controller),
+                              "port": str(port),
+                              "hostbus": str(busnum),
+                              "hostaddr": str(devnum)})
+
         with self.__get_qmp_socket() as sock:
-            result = await self.__send_qmp_command(sock, "device_add",
-                                                   {"id": "xenusb-{}-{}".format(busnum, devnum),
-                                                    "driver": "usb-host",
-                                                    "bus": "xenusb-{}.0".format(controller),
-                                                    "port": str(port),
-                                                    "hostbus": str(busnum),
-                                                    "hostaddr": str(devnum)}
-                                                   )
+            result = await self.__send_qmp_command(sock, "device_add", qmp_arguments)
             if "error" in result:
                 raise QmpError(result["error"])
 
-    async def detach_usb_device(self, busnum: int, devnum: int) -> None:
+    # QEMU finishes the removal asynchronously, so don't return until it confirms with DEVICE_DELETED.
+    # A device QEMU doesn't know about is already gone: an earlier attempt removed it, but then failed
+    # to update xenstore or gave up waiting for the event, and the retry still has to free the slot.
+    async def __delete_device(self, device_id: str) -> None:
         with self.__get_qmp_socket() as sock:
-            result = await self.__send_qmp_command(sock, "device_del", {"id": "xenusb-{}-{}".format(busnum, devnum)})
+            waiter = sock.expect_device_deleted(device_id)
+            try:
+                result = await self.__send_qmp_command(sock, "device_del", {"id": device_id})
+                if "error" in result and result["error"].get("class") == "DeviceNotFound":
+                    self.__options.print_verbose("{} is already gone from QEMU".format(device_id))
+                    return
+                if "error" in result:
+                    raise QmpError(result["error"])
 
-            if "error" in result:
-                raise QmpError(result["error"])
+                await sock.wait_for_device_deleted(device_id, waiter, DEVICE_DELETED_TIMEOUT)
+            finally:
+                sock.forget_device_waiter(device_id)
+            self.__options.print_very_verbose("QEMU confirmed removal of {}".format(device_id))
+
+    async def detach_usb_device(self, busnum: int, devnum: int) -> None:
+        await self.__delete_device("xenusb-{}-{}".format(busnum, devnum))
 
-    async def create_usb_controller(self, controller_id: int) -> None:
+    async def create_usb_controller(self, controller_id: int, usb_version: int) -> None:
         qmp_arguments = {"id": "xenusb-{}".format(controller_id),
-                         "driver": ["piix3-usb-uhci", "usb-ehci", "nec-usb-xhci"][self.__options.usb_version - 1]}
+                         "driver": ["piix3-usb-uhci", "usb-ehci", "nec-usb-xhci"][usb_version - 1]}
 
-        if self.__options.usb_version == 3:
+        if usb_version == 3:
             qmp_arguments.update({"p2": "15", "p3": "15"})
 
         with self.__get_qmp_socket() as sock:
@@ -235,8 +462,15 @@ class Qmp:
             if "error" in result:
                 raise QmpError(result["error"])
 
+    async def remove_usb_controller(self, controller_id: int) -> None:
+        await self.__delete_device("xenusb-{}".format(controller_id))
+
     async def get_usb_host(self, controller: int, port: int) -> Optional[XenUsb]:
         with self.__get_qmp_socket() as sock:
+            if (await self.__get_capabilities(sock)).has("qom-list-get"):
+                return next((u for u in await self.__get_usb_hosts(sock)
+                             if (u.controller, u.port) == (controller, port)), None)
+
             controller_devices = await self.__qom_list(sock, "xenusb-{}.0".format(controller))
             if controller_devices is None:
                 return None
@@ -249,23 +483,27 @@ class Qmp:
 
     async def get_usb_devices(self) -> AsyncIterable:
         with self.__get_qmp_socket() as sock:
-            async for controller_id in self.__get_usb_controller_ids(sock):
-                async for usb_dev in self.__get_usb_devices(sock, controller_id):
-                    yield usb_dev
+            for usb_dev in await self.__get_usb_hosts(sock):
+                yield usb_dev
 
     async def monitor_domain(self) -> None:
         if self.__options.qmp_socket is None:
             raise QmpError({"error": "Cannot monitor domain without a dedicated UNIX socket"})
 
+        warned = False
+
+        async def monitor() -> None:
+            nonlocal warned
+            try:
+                await sock.monitor()
+            except FileNotFoundError:
+                if not warned:
+                    self.__options.print_unless_quiet("Dedicated UNIX socket does not exist, waiting...")
+                    warned = True
+                raise
+
         with self.__get_qmp_socket() as sock:
-            while True:
-                try:
-                    await sock.monitor()
-                    break
-                except FileNotFoundError:
-                    self.__options.print_unless_quiet("Dedicated UNIX socket does not exist, waiting 5s...")
-                    await asyncio.sleep(5.0)
-                    continue
+            await self.__retry.run("qmp monitor", monitor, (FileNotFoundError,), SOCKET_RETRY_POLICY)
 
     def set_socket_path(self, socket_path: str) -> None:
         if self.__options.qmp_socket is not None:
@@ -277,11 +515,14 @@ class Qmp:
     def is_connected(self) -> asyncio.Event:
         return self.__connected_event
 
-    def __init__(self, options: Options):
+    def __init__(self, options: Options, retry: RetryScheduler, recorder: Optional[TraceRecorder] = None):
         super().__init__()
         self.__options = options
+        self.__retry = retry
+        self.__recorder = recorder
         self.__path = self.__options.qmp_socket
         self.__qmp_socket = None
+        self.__capabilities = None
         self.__connected_event = asyncio.Event()
 
         self.domain_reboot = AsyncEvent()
@@ -337,4 +578,5 @@ class QmpError(Exception):
 
 # For adding a chardev at runtime:
 # {"execute": "chardev-add", "arguments": {"id": "test", "backend": {"type": "socket", "data": { "addr": {"data": {"path": "/var/run/xen/qmp-test"}, "type": "unix"}}, "server": true, "wait": false}}}
-# I don't (yet) see a way to tell qmp to put this chardev into "mode=control" as done on the commandline.
+# There is no QMP (or HMP) command to put this chardev into "mode=control" as done on the commandline, so
+# without a dedicated socket XenDomain.watch_lifecycle follows reboots and shutdowns through xenstore instead.
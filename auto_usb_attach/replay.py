@@ -0,0 +1,272 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from .__main__ import MainThread
+from .devicemonitor import DeviceMonitor, BURST_WINDOW_MAX
+from .qmp import Qmp
+from .trace import TraceRecorder, RecordedDevice
+from .xendomain import XenDomain
+from .xenstore import HEADER, XS_DIRECTORY, XS_READ, XS_RM, XS_TRANSACTION_END, XS_TRANSACTION_START, XS_WRITE, \
+    XS_ERROR
+
+
+# An in-memory xenstored, seeded with every value the recorded run read before it wrote anything
+class ReplayXenstored:
+    def __seed(self, records: List[Dict[str, Any]]) -> None:
+        written = set()
+        for record in (r for r in records if r["s"] == "xs"):
+            path = record["p"]
+            if record["op"] in ("write", "rm"):
+                written.add(path)
+            elif record["e"] is not None or path in written:
+                continue
+            elif record["op"] == "read":
+                self.__tree.setdefault(path, record["r"])
+            elif record["op"] == "directory":
+                self.__tree.setdefault(path, "")
+                for child in (c for c in record["r"].split("\0") if len(c) > 0):
+                    self.__tree.setdefault("{}/{}".format(path, child), "")
+
+    def __children(self, path: str) -> List[str]:
+        prefix = path.rstrip("/") + "/"
+        return sorted({p[len(prefix):].split("/")[0] for p in self.__tree if p.startswith(prefix)})
+
+    def __exists(self, path: str) -> bool:
+        return path in self.__tree or len(self.__children(path)) > 0
+
+    def __set(self, tx_id: int, path: str, value: Optional[str]) -> None:
+        affected = [p for p in self.__tree if p == path or p.startswith(path + "/")] if value is None else [path]
+        if tx_id in self.__transactions:
+            self.__transactions[tx_id].extend((p, self.__tree.get(p)) for p in affected)
+
+        for affected_path in affected:
+            if value is None:
+                self.__tree.pop(affected_path, None)
+            else:
+                self.__tree[affected_path] = value
+
+    def __handle(self, msg_type: int, tx_id: int, payload: bytes) -> Tuple[int, bytes]:
+        parts = payload.split(b"\0", 1)
+        path = parts[0].decode("ascii")
+        if msg_type == XS_READ:
+            if path not in self.__tree:
+                return XS_ERROR, b"ENOENT\0"
+            return msg_type, bytes(self.__tree[path], "ascii")
+        if msg_type == XS_DIRECTORY:
+            if not self.__exists(path):
+                return XS_ERROR, b"ENOENT\0"
+            return msg_type, b"".join(bytes(c, "ascii") + b"\0" for c in self.__children(path))
+        if msg_type == XS_WRITE:
+            self.__set(tx_id, path, parts[1].decode("ascii"))
+        elif msg_type == XS_RM:
+            self.__set(tx_id, path, None)
+        elif msg_type == XS_TRANSACTION_START:
+            self.__next_tx_id += 1
+            self.__transactions[self.__next_tx_id] = []
+            return msg_type, bytes(str(self.__next_tx_id), "ascii") + b"\0"
+        elif msg_type == XS_TRANSACTION_END:
+            undo = self.__transactions.pop(tx_id, [])
+            if path == "F":
+                for undo_path, old_value in reversed(undo):
+                    self.__set(0, undo_path, old_value)
+        return msg_type, b"OK\0"
+
+    async def __serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                msg_type, req_id, tx_id, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+                reply_type, reply = self.__handle(msg_type, tx_id, await reader.readexactly(length))
+                writer.write(HEADER.pack(reply_type, req_id, tx_id, len(reply)) + reply)
+        except asyncio.IncompleteReadError:
+            writer.close()
+
+    async def start(self, path: str) -> None:
+        self.__server = await asyncio.start_unix_server(self.__serve, path)
+
+    def close(self) -> None:
+        if self.__server is not None:
+            self.__server.close()
+
+    def __init__(self, records: List[Dict[str, Any]]):
+        self.__tree: Dict[str, str] = {}
+        self.__transactions: Dict[int, List[Tuple[str, Optional[str]]]] = {}
+        self.__next_tx_id = 0
+        self.__server = None
+        self.__seed(records)
+
+    def __repr__(self):
+        return "ReplayXenstored({} nodes)".format(len(self.__tree))
+
+
+# A QMP endpoint that answers each command with the response the recorded run got for the same command
+class ReplayQmp:
+    @staticmethod
+    def __key(command: Dict[str, Any]) -> str:
+        return json.dumps({"execute": command.get("execute"), "arguments": command.get("arguments", {})},
+                          sort_keys=True)
+
+    def __seed(self, records: List[Dict[str, Any]]) -> None:
+        waiting: Dict[str, Deque[str]] = {}
+        for record in (r for r in records if r["s"] == "qmp"):
+            message = json.loads(record["l"])
+            if record["d"] == "out":
+                waiting.setdefault(record["c"], deque()).append(self.__key(message))
+            elif "QMP" in message:
+                self.__greeting = message
+            elif ("return" in message or "error" in message) and len(waiting.get(record["c"], [])) > 0:
+                self.__responses.setdefault(waiting[record["c"]].popleft(), deque()).append(message)
+
+    def __respond(self, command: Dict[str, Any]) -> List[Dict[str, Any]]:
+        recorded = self.__responses.get(self.__key(command))
+        response = dict(recorded.popleft()) if recorded else {"return": {}}
+        response.pop("id", None)
+        if "id" in command:
+            response["id"] = command["id"]
+
+        messages = [response]
+        if command.get("execute") == "device_del" and "return" in response:
+            messages.append({"event": "DEVICE_DELETED", "data": {"device": command["arguments"]["id"]},
+                             "timestamp": {"seconds": int(time.time()), "microseconds": 0}})
+        return messages
+
+    async def __serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        decoder = json.JSONDecoder()
+        writer.write(bytes(json.dumps(self.__greeting) + "\r\n", "utf-8"))
+        buffer = ""
+        while True:
+            data = await reader.read(4096)
+            if len(data) == 0:
+                writer.close()
+                return
+            buffer += str(data, "utf-8")
+            while len(buffer.strip()) > 0:
+                try:
+                    command, end = decoder.raw_decode(buffer.lstrip())
+                except ValueError:
+                    break
+                buffer = buffer.lstrip()[end:]
+                for message in self.__respond(command):
+                    writer.write(bytes(json.dumps(message) + "\r\n", "utf-8"))
+
+    async def start(self, path: str) -> None:
+        self.__server = await asyncio.start_unix_server(self.__serve, path)
+
+    def close(self) -> None:
+        if self.__server is not None:
+            self.__server.close()
+
+    def __init__(self, records: List[Dict[str, Any]]):
+        self.__greeting = {"QMP": {"version": {}, "capabilities": []}}
+        self.__responses: Dict[str, Deque[Dict[str, Any]]] = {}
+        self.__server = None
+        self.__seed(records)
+
+    def __repr__(self):
+        return "ReplayQmp({} commands)".format(len(self.__responses))
+
+
+class ReplayDriver:
+    def __get_args(self, qmp_socket: str) -> List[str]:
+        header = next(r for r in self.__records if r["s"] == "header")
+        args = ["auto_usb_attach", "-q", "-d", header["domain"], "-s", qmp_socket,
+                "--usb-version", str(header["usb_version"] or "auto"), "--placement", header["placement"]]
+        for hub in header["hubs"]:
+            args.extend(["-u", hub])
+        for device in header["devices"]:
+            args.extend(["-x", device])
+        return args
+
+    async def __feed_events(self, monitor: DeviceMonitor) -> None:
+        for record in (r for r in self.__records if r["s"] == "hub"):
+            await monitor.add_hub_device(RecordedDevice(record["d"]))
+
+        # Events that arrived close together are handed over as one burst, as the live monitor would
+        bursts: List[List[Dict[str, Any]]] = []
+        for record in (r for r in self.__records if r["s"] == "udev"):
+            if len(bursts) > 0 and record["t"] - bursts[-1][-1]["t"] <= BURST_WINDOW_MAX:
+                bursts[-1].append(record)
+            else:
+                bursts.append([record])
+
+        last = None
+        for burst in bursts:
+            if last is not None and self.__speed > 0:
+                await asyncio.sleep(max(0.0, burst[0]["t"] - last) / self.__speed)
+            last = burst[-1]["t"]
+            await monitor.handle_events([RecordedDevice(record["d"]) for record in burst])
+
+    async def run(self) -> TraceRecorder:
+        with tempfile.TemporaryDirectory() as directory:
+            xenstored = ReplayXenstored(self.__records)
+            qmp_server = ReplayQmp(self.__records)
+            await xenstored.start(os.path.join(directory, "xenstored"))
+            await qmp_server.start(os.path.join(directory, "qmp"))
+            os.environ["XENSTORED_PATH"] = os.path.join(directory, "xenstored")
+
+            recorder = TraceRecorder(None, None)
+            thread = MainThread(self.__get_args(os.path.join(directory, "qmp")), recorder)
+            qmp = Qmp(thread.options, thread.retry, recorder)
+            monitor_task = asyncio.ensure_future(qmp.monitor_domain())
+            try:
+                with await XenDomain.wait_for_domain(thread.options, qmp, thread.retry, recorder) as xen_domain:
+                    await qmp.is_connected.wait()
+                    monitor = thread.build_monitor(xen_domain)
+                    for device in thread.options.specific_devices:
+                        await monitor.add_specific_device(device, scan=False)
+                    await self.__feed_events(monitor)
+            finally:
+                monitor_task.cancel()
+                qmp_server.close()
+                xenstored.close()
+
+        return recorder
+
+    def report(self, replayed: TraceRecorder) -> str:
+        recorded: Dict[str, List[float]] = {}
+        for record in (r for r in self.__records if r["s"] == "stage"):
+            recorded.setdefault(record["n"], []).append(record["ms"] / 1000)
+
+        def summary(samples: List[float]) -> str:
+            if len(samples) == 0:
+                return "{:>6} {:>9} {:>9}".format(0, "-", "-")
+            ordered = sorted(samples)
+            p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+            return "{:>6} {:>9.3f} {:>9.3f}".format(len(samples), 1000 * sum(samples) / len(samples), 1000 * p95)
+
+        lines = ["{:<28} {:>26}   {:>26}".format("stage", "recorded (n, mean ms, p95)",
+                                                 "replayed (n, mean ms, p95)")]
+        for name in sorted(set(recorded) | set(replayed.stages)):
+            lines.append("{:<28} {}   {}".format(name, summary(recorded.get(name, [])),
+                                                 summary(replayed.stages.get(name, []))))
+        return "\n".join(lines)
+
+    def __init__(self, trace_file: str, speed: float):
+        self.__trace_file = trace_file
+        self.__records = TraceRecorder.load(trace_file)
+        self.__speed = speed
+
+    def __repr__(self):
+        return "ReplayDriver({!r}, {!r})".format(self.__trace_file, self.__speed)
+
+
+def main(args: List[str]) -> None:
+    parser = argparse.ArgumentParser(prog="{} -m auto_usb_attach.replay".format(os.path.basename(sys.executable)))
+    parser.add_argument("trace", help="trace file written with --record")
+    parser.add_argument("--speed", help="replay speed multiplier, 0 for as fast as possible (defaults to 1)",
+                        type=float, default=1.0)
+    parsed = parser.parse_args(args[1:])
+
+    driver = ReplayDriver(parsed.trace, parsed.speed)
+    replayed = asyncio.get_event_loop().run_until_complete(driver.run())
+    print(driver.report(replayed))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
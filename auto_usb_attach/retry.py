@@ -0,0 +1,128 @@
+import asyncio
+import random
+from typing import Any, Awaitable, Callable, Dict, Iterator, Optional, Tuple, Type
+
+from .options import Options
+
+
+class RetryPolicy:
+    @property
+    def deadline(self) -> Optional[float]:
+        return self.__deadline
+
+    # Exponential backoff with jitter: each delay is drawn from the upper part of
+    # [delay * (1 - jitter), delay], so concurrent retries spread out without collapsing to zero.
+    def delays(self) -> Iterator[float]:
+        delay = self.__initial_delay
+        while True:
+            yield delay * (1 - self.__jitter * random.random())
+            delay = min(delay * self.__multiplier, self.__max_delay)
+
+    def __init__(self, initial_delay: float = 0.02, max_delay: float = 5.0, multiplier: float = 2.0,
+                 jitter: float = 0.5, deadline: Optional[float] = None):
+        self.__initial_delay = initial_delay
+        self.__max_delay = max_delay
+        self.__multiplier = multiplier
+        self.__jitter = jitter
+        self.__deadline = deadline
+
+    def __repr__(self):
+        return "RetryPolicy({!r}, {!r}, {!r}, {!r}, {!r})".format(self.__initial_delay, self.__max_delay,
+                                                                 self.__multiplier, self.__jitter, self.__deadline)
+
+
+class RetryCounters:
+    @property
+    def attempts(self) -> int:
+        return self.__counts["attempts"]
+
+    @property
+    def retries(self) -> int:
+        return self.__counts["retries"]
+
+    @property
+    def successes(self) -> int:
+        return self.__counts["successes"]
+
+    @property
+    def failures(self) -> int:
+        return self.__counts["failures"]
+
+    @property
+    def deferred(self) -> int:
+        return self.__counts["deferred"]
+
+    def increment(self, counter: str) -> None:
+        self.__counts[counter] += 1
+
+    def __init__(self):
+        self.__counts = {"attempts": 0, "retries": 0, "successes": 0, "failures": 0, "deferred": 0}
+
+    def __repr__(self):
+        return "RetryCounters({!r})".format(self.__counts)
+
+    def __str__(self):
+        return ", ".join("{} {}".format(v, k) for k, v in self.__counts.items())
+
+
+class RetryScheduler:
+    @property
+    def counters(self) -> Dict[str, RetryCounters]:
+        return self.__counters
+
+    def __get_counters(self, name: str) -> RetryCounters:
+        if name not in self.__counters:
+            self.__counters[name] = RetryCounters()
+        return self.__counters[name]
+
+    async def run(self, name: str, operation: Callable[[], Awaitable[Any]],
+                  retry_on: Tuple[Type[BaseException], ...], policy: Optional[RetryPolicy] = None) -> Any:
+        policy = policy or self.__default_policy
+        counters = self.__get_counters(name)
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        delays = policy.delays()
+
+        while True:
+            counters.increment("attempts")
+            try:
+                result = await operation()
+            except retry_on as e:
+                delay = next(delays)
+                if policy.deadline is not None and loop.time() - start + delay > policy.deadline:
+                    counters.increment("failures")
+                    self.__options.print_verbose("{} failed after {:.2f}s: {}".format(name, loop.time() - start, e))
+                    raise
+                counters.increment("retries")
+                self.__options.print_very_verbose("{} failed ({}), retrying in {:.3f}s".format(name, e, delay))
+                await asyncio.sleep(delay)
+                continue
+
+            counters.increment("successes")
+            return result
+
+    # Keep retrying a failed operation in the background instead of dropping it
+    def defer(self, name: str, operation: Callable[[], Awaitable[Any]],
+              retry_on: Tuple[Type[BaseException], ...], policy: Optional[RetryPolicy] = None) -> asyncio.Future:
+        self.__get_counters(name).increment("deferred")
+
+        async def deferred() -> Any:
+            try:
+                return await self.run(name, operation, retry_on, policy)
+            except retry_on as e:
+                self.__options.print_unless_quiet("Giving up on {}: {}".format(name, e))
+                return None
+
+        return asyncio.ensure_future(deferred())
+
+    def print_counters(self) -> None:
+        for name, counters in sorted(self.__counters.items()):
+            self.__options.print_verbose("Retries for {}: {}".format(name, counters))
+
+    def __init__(self, options: Options, default_policy: Optional[RetryPolicy] = None):
+        self.__options = options
+        self.__default_policy = default_policy or RetryPolicy()
+        self.__counters: Dict[str, RetryCounters] = {}
+
+    def __repr__(self):
+        return "RetryScheduler({!r}, {!r})".format(self.__options, self.__default_policy)
@@ -0,0 +1,137 @@
+import json
+import time
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional
+
+from .options import Options
+
+
+# Enough of a udev device to push it back through DeviceMonitor without sysfs
+class RecordedDevice:
+    @property
+    def device_path(self) -> str:
+        return self.__data["device_path"]
+
+    @property
+    def busnum(self) -> int:
+        return self.__data["busnum"]
+
+    @property
+    def devnum(self) -> int:
+        return self.__data["devnum"]
+
+    @property
+    def vendor_id(self) -> str:
+        return self.__data["vendor_id"]
+
+    @property
+    def product_id(self) -> str:
+        return self.__data["product_id"]
+
+    @property
+    def serial(self) -> str:
+        return self.__data.get("serial", "")
+
+    @property
+    def speed(self) -> float:
+        return self.__data["speed"]
+
+    @property
+    def interface_classes(self) -> FrozenSet[int]:
+        return frozenset(self.__data["interface_classes"])
+
+    @property
+    def sys_name(self) -> str:
+        return self.__data["sys_name"]
+
+    @property
+    def action(self) -> str:
+        return self.__data["action"]
+
+    @property
+    def children(self) -> Iterable["RecordedDevice"]:
+        return []
+
+    def is_a_hub(self) -> bool:
+        return self.__data["hub"]
+
+    def is_a_root_device(self) -> bool:
+        return self.__data["root"]
+
+    @staticmethod
+    def snapshot(device) -> Dict[str, Any]:
+        return {"device_path": device.device_path,
+                "sys_name": device.sys_name,
+                "action": device.action,
+                "busnum": device.busnum,
+                "devnum": device.devnum,
+                "vendor_id": device.vendor_id,
+                "product_id": device.product_id,
+                "serial": device.serial,
+                "speed": device.speed,
+                "interface_classes": sorted(device.interface_classes),
+                "hub": device.is_a_hub(),
+                "root": device.is_a_root_device()}
+
+    def __init__(self, data: Dict[str, Any]):
+        self.__data = data
+
+    def __repr__(self):
+        return "RecordedDevice({!r})".format(self.__data)
+
+
+# Writes one compact JSON object per line:
+#   {"t": seconds since start, "s": stream, ...}
+# where stream is one of "header", "hub", "udev", "xs", "qmp" or "stage".
+# Stage records carry per-operation latencies so a replay can be compared with the original run.
+class TraceRecorder:
+    @property
+    def stages(self) -> Dict[str, List[float]]:
+        return self.__stages
+
+    def __write(self, stream: str, **fields) -> None:
+        if self.__file is None:
+            return
+        fields.update({"t": round(time.monotonic() - self.__start, 6), "s": stream})
+        self.__file.write(json.dumps(fields, separators=(",", ":")) + "\n")
+
+    def header(self, options: Options) -> None:
+        self.__write("header", domain=options.domain, hubs=options.hubs, devices=options.specific_devices,
+                     usb_version=options.usb_version, placement=options.placement_policy)
+
+    def hub(self, device) -> None:
+        self.__write("hub", d=RecordedDevice.snapshot(device))
+
+    def udev(self, device) -> None:
+        self.__write("udev", d=RecordedDevice.snapshot(device))
+
+    def xenstore(self, op: str, path: str, value: Optional[str], result: Any, error: Optional[str]) -> None:
+        self.__write("xs", op=op, p=path, v=value, r=result, e=error)
+
+    def qmp(self, channel: str, direction: str, line: str) -> None:
+        self.__write("qmp", c=channel, d=direction, l=line)
+
+    # Latencies are only kept in memory when there is no file to put them in (i.e. during a replay)
+    def stage(self, name: str, duration: float) -> None:
+        if self.__file is None:
+            self.__stages.setdefault(name, []).append(duration)
+        self.__write("stage", n=name, ms=round(duration * 1000, 3))
+
+    def close(self) -> None:
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+    @staticmethod
+    def load(path: str) -> List[Dict[str, Any]]:
+        with open(path) as trace_file:
+            return [json.loads(line) for line in trace_file if line.strip()]
+
+    def __init__(self, options: Optional[Options], path: Optional[str]):
+        self.__options = options
+        self.__path = path
+        self.__file = open(path, "w", buffering=1) if path is not None else None
+        self.__start = time.monotonic()
+        self.__stages: Dict[str, List[float]] = {}
+
+    def __repr__(self):
+        return "TraceRecorder({!r}, {!r})".format(self.__options, self.__path)
@@ -0,0 +1,36 @@
+from typing import Any, Dict
+
+from .device import Device
+from .options import Options
+from .placement import DeviceProfile
+
+# Applied in this order, so on a composite device the later class wins (a webcam's video settings
+# over its microphone's, say).  A <vendor-id>:<product-id> entry is applied last of all.
+CLASS_ORDER = ("other", "hub", "hid", "storage", "audio", "video")
+
+
+class UsbHostTuning:
+    # device_add goes through QemuOpts, which wants strings (and "on"/"off" for booleans)
+    @staticmethod
+    def __format(value: Any) -> str:
+        if isinstance(value, bool):
+            return "on" if value else "off"
+        return str(value)
+
+    # Extra usb-host properties for a device; empty unless the config asks for some,
+    # so QEMU's own defaults apply as before
+    def arguments(self, device: Device) -> Dict[str, str]:
+        classes = DeviceProfile.from_device(device).classes or frozenset(["other"])
+        tuning = {}
+        for device_class in (c for c in CLASS_ORDER if c in classes):
+            tuning.update(self.__options.usb_host_options.get(device_class) or {})
+        device_id = "{}:{}".format(device.vendor_id, device.product_id)
+        tuning.update(self.__options.device_usb_host_options.get(device_id) or {})
+
+        return {name: self.__format(value) for name, value in tuning.items()}
+
+    def __init__(self, options: Options):
+        self.__options = options
+
+    def __repr__(self):
+        return "UsbHostTuning({!r})".format(self.__options)
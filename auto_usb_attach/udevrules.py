@@ -0,0 +1,30 @@
+from typing import List
+
+from .options import Options
+
+DEFAULT_UDEV_TAG = "auto-usb-attach"
+RULES_HEADER = """# Generated by auto-usb-attach for domain {domain}.
+# Tags the watched usb devices so the monitor can filter with --udev-tag {tag}.
+# Regenerate this file (and run "udevadm control --reload") after changing hubs or devices.
+"""
+
+
+# KERNELS matches the device itself or any parent, so a hub rule covers everything plugged in below it.
+# udev keeps tags in its database, so the remove events carry them as well.
+def render_udev_rules(options: Options) -> str:
+    tag = options.udev_tag or DEFAULT_UDEV_TAG
+    match = 'SUBSYSTEM=="usb", ENV{DEVTYPE}=="usb_device"'
+    lines: List[str] = []
+    for hub in options.hubs:
+        lines.append('{}, KERNELS=="{}", TAG+="{}"'.format(match, hub, tag))
+    for device_id in options.specific_devices:
+        vendor_id, product_id = device_id.split(":")
+        lines.append('{}, ATTR{{idVendor}}=="{}", ATTR{{idProduct}}=="{}", TAG+="{}"'.format(match, vendor_id,
+                                                                                           product_id, tag))
+    return RULES_HEADER.format(domain=options.domain, tag=tag) + "\n".join(lines) + "\n"
+
+
+def write_udev_rules(options: Options) -> None:
+    with open(options.udev_rules_file, "w") as rules_file:
+        rules_file.write(render_udev_rules(options))
+    options.print_unless_quiet("Wrote udev rules to {}".format(options.udev_rules_file))
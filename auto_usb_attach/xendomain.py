@@ -1,19 +1,27 @@
 import asyncio
+import time
 from functools import partial
-from typing import Tuple, Optional, Callable, Iterable, List
-from collections import AsyncIterable
-import pyxs
-import re
+from typing import Tuple, Optional, Callable, List, AsyncIterable, Dict, Set, Union
 
 from .device import Device
+from .identity import SlotMemory
 from .options import Options
+from .placement import Placement, ControllerState
+from .plan import Plan
 from .qmp import Qmp, QmpError
+from .retry import RetryScheduler, RetryPolicy
+from .trace import TraceRecorder
+from .tuning import UsbHostTuning
+from .xenstore import XenstoreClient, XenstoreError
 from .xenusb import XenUsb
+from .asyncevent import AsyncEvent
 
-# There is a bug in the latest version of pyxs.
-# There is a pending PR for it: https://github.com/selectel/pyxs/pull/13
-# In the meantime, this should fix it.
-pyxs.client._re_7bit_ascii = re.compile(b"^[\x00\x20-\x7f]*$")
+DOMAIN_RETRY_POLICY = RetryPolicy(initial_delay=0.05, max_delay=5.0)
+LIFECYCLE_TOKEN = "auto-usb-attach-lifecycle"
+# How long to wait for a domain of the same name to come back before calling it a shutdown
+REBOOT_GRACE = 10.0
+REBOOT_POLL_INTERVAL = 0.5
+COMMIT_ATTEMPTS = 5
 
 
 # xenstore paths of interest:
@@ -22,121 +30,448 @@ pyxs.client._re_7bit_ascii = re.compile(b"^[\x00\x20-\x7f]*$")
 # /libxl/*/device/vusb/* -- Virtual USB controllers
 # /libxl/*/device/vusb/*/port/* -- Mapped ports (look up in /sys/bus/usb/devices)
 class XenDomain:
-    def __set_xs_value(self, xs_path: str, xs_value: str) -> None:
-        self.__xs_client[bytes(xs_path, "ascii")] = bytes(xs_value, "ascii")
-
-    def __get_xs_list(self, xs_path: str) -> Iterable[str]:
-        return (_.decode("ascii") for _ in self.__xs_client.list(bytes(xs_path, "ascii")))
-
-    def __get_xs_value(self, xs_path: str) -> str:
-        return self.__xs_client[bytes(xs_path, "ascii")].decode("ascii")
+    # A value of None removes the node and everything under it
+    async def __set_xs_value(self, xs_path: str, xs_value: Optional[str], tx_id: int = 0) -> None:
+        if xs_value is None:
+            await self.__xs_client.rm(xs_path, tx_id)
+        else:
+            await self.__xs_client.write(xs_path, xs_value, tx_id)
+
+    async def __get_xs_list(self, xs_path: str) -> List[str]:
+        if self.__plan is None:
+            return await self.__xs_client.directory(xs_path)
+
+        prefix = xs_path + "/"
+        planned = {p[len(prefix):].split("/")[0] for p in self.__plan.xenstore if p.startswith(prefix)}
+        try:
+            existing = await self.__xs_client.directory(xs_path)
+        except XenstoreError as e:
+            if e.errno != "ENOENT" or len(planned) == 0:
+                raise
+            existing = []
+        return existing + sorted(planned - set(existing))
+
+    async def __get_xs_value(self, xs_path: str) -> str:
+        if self.__plan is not None and xs_path in self.__plan.xenstore:
+            return self.__plan.xenstore[xs_path]
+        return await self.__xs_client.read(xs_path)
+
+    # Writes inside one transaction don't depend on each other, so send them all before waiting on any
+    async def __set_xs_values(self, xs_list: List[Tuple[str, Optional[str]]], tx_id: int) -> None:
+        await asyncio.gather(*(self.__set_xs_value(xs_path, xs_value, tx_id) for xs_path, xs_value in xs_list))
+
+    async def __rollback(self, tx_id: int) -> None:
+        try:
+            await self.__xs_client.rollback(tx_id)
+        except XenstoreError as e:
+            self.__options.print_debug("Rollback of transaction {} failed: {}".format(tx_id, e))
 
-    def __get_qmp_add_usb(self, busnum: int, devnum: int, controller: int, port: int) -> Callable[[], None]:
-        return partial(self.__qmp.attach_usb_device, busnum, devnum, controller, port)
+    def __get_qmp_add_usb(self, busnum: int, devnum: int, controller: int, port: int,
+                          tuning: Dict[str, str]) -> Callable[[], None]:
+        return partial(self.__qmp.attach_usb_device, busnum, devnum, controller, port, tuning)
 
     def __get_qmp_del_usb(self, busnum: int, devnum: int) -> Callable[[], None]:
         return partial(self.__qmp.detach_usb_device, busnum, devnum)
 
-    def __get_qmp_add_controller(self, controller: int) -> Callable[[], None]:
-        return partial(self.__qmp.create_usb_controller, controller)
+    def __get_qmp_add_controller(self, controller: int, usb_version: int) -> Callable[[], None]:
+        return partial(self.__qmp.create_usb_controller, controller, usb_version)
+
+    # xenstored answers EAGAIN when a concurrent transaction touched the same nodes.  By then QEMU has already
+    # carried out the command, so the same writes are made again in a fresh transaction rather than given up on.
+    async def __commit(self, tx_id: int, xs_list: List[Tuple[str, Optional[str]]]) -> None:
+        for attempt in range(1, COMMIT_ATTEMPTS + 1):
+            try:
+                await self.__xs_client.commit(tx_id)
+                return
+            except XenstoreError as e:
+                if e.errno != "EAGAIN" or attempt == COMMIT_ATTEMPTS:
+                    raise
+                self.__options.print_debug("Transaction {} conflicted, retrying".format(tx_id))
+
+            tx_id = await self.__xs_client.transaction()
+            try:
+                await self.__set_xs_values(xs_list, tx_id)
+            except XenstoreError:
+                await self.__rollback(tx_id)
+                raise
+
+    # If xenstore can't be made to agree, undo_command takes the change back out of QEMU
+    async def __set_xenstore_and_send_command(self, xs_list: List[Tuple[str, str]], qmp_command: Callable[[], None],
+                                              undo_command: Callable[[], None], kind: str, description: str) -> None:
+        if self.__plan is not None:
+            self.__plan.add(kind, description, dict(xs_list), 1)
+            return
+
+        try:
+            tx_id = await self.__xs_client.transaction()
+        except XenstoreError as e:
+            self.__options.print_unless_quiet("Caught exception: {}".format(e))
+            raise XenError(e)
+
+        try:
+            await self.__set_xs_values(xs_list, tx_id)
+            await qmp_command()
+        except (XenstoreError, QmpError) as e:
+            await self.__rollback(tx_id)
+            self.__options.print_unless_quiet("Caught exception: {}".format(e))
+            raise XenError(e)
+
+        try:
+            await self.__commit(tx_id, xs_list)
+        except XenstoreError as e:
+            self.__options.print_unless_quiet("Could not record {} {} in xenstore ({}), undoing it"
+                                              .format(kind, description, e))
+            try:
+                await undo_command()
+            except QmpError as undo_error:
+                self.__options.print_unless_quiet("Could not undo {} {}: {}".format(kind, description, undo_error))
+            raise XenError(e)
+
+    # Used for removals: the xenstore slot is only released once QEMU has confirmed the device is gone,
+    # so nothing can be attached to a port that is still busy in the device model.
+    async def __send_command_and_set_xenstore(self, qmp_command: Callable[[], None],
+                                              xs_list: List[Tuple[str, Optional[str]]], kind: str,
+                                              description: str) -> None:
+        if self.__plan is not None:
+            self.__plan.add(kind, description, dict(xs_list), 1)
+            return
 
-    async def __set_xenstore_and_send_command(self, xs_list: List[Tuple[str, str]],
-                                              qmp_command: Callable[[], None]) -> None:
-        txn_id = self.__xs_client.transaction()
         try:
-            for xs_path, xs_value in xs_list:
-                self.__set_xs_value(xs_path, xs_value)
             await qmp_command()
-        except (pyxs.PyXSError, QmpError) as e:
-            if txn_id is not None:
-                self.__xs_client.rollback()
+        except QmpError as e:
             self.__options.print_unless_quiet("Caught exception: {}".format(e))
             raise XenError(e)
 
-        self.__xs_client.commit()
+        try:
+            tx_id = await self.__xs_client.transaction()
+        except XenstoreError as e:
+            self.__options.print_unless_quiet("Caught exception: {}".format(e))
+            raise XenError(e)
 
-    async def __create_controller(self, controller: int) -> None:
+        try:
+            await self.__set_xs_values(xs_list, tx_id)
+        except XenstoreError as e:
+            await self.__rollback(tx_id)
+            self.__options.print_unless_quiet("Caught exception: {}".format(e))
+            raise XenError(e)
+
+        try:
+            await self.__commit(tx_id, xs_list)
+        except XenstoreError as e:
+            self.__options.print_unless_quiet("Could not record {} {} in xenstore: {}".format(kind, description, e))
+            raise XenError(e)
+
+    async def __create_controller(self, controller: int, usb_version: int) -> ControllerState:
         path = "/libxl/{}/device/vusb".format(self.__domain_id)
-        num_ports = [2, 6, 15][self.__options.usb_version-1]
+        num_ports = [2, 6, 15][usb_version-1]
         xenstore_entries = [
             (path, ""),
             ("{}/{}".format(path, controller), ""),
             ("{}/{}/type".format(path, controller), "devicemodel"),
-            ("{}/{}/usb-ver".format(path, controller), str(self.__options.usb_version)),
+            ("{}/{}/usb-ver".format(path, controller), str(usb_version)),
             ("{}/{}/num-ports".format(path, controller), str(num_ports)),
             ("{}/{}/port".format(path, controller), "")
         ]
         for port in range(1, num_ports+1):
             xenstore_entries.append(("{}/{}/port/{}".format(path, controller, port), ""))
 
-        await self.__set_xenstore_and_send_command(xenstore_entries, self.__get_qmp_add_controller(controller))
-
-    def __check_for_vusb(self) -> bool:
+        await self.__set_xenstore_and_send_command(xenstore_entries,
+                                                   self.__get_qmp_add_controller(controller, usb_version),
+                                                   partial(self.__qmp.remove_usb_controller, controller), "create",
+                                                   "controller {} (USB {}, {} ports)".format(controller, usb_version,
+                                                                                            num_ports))
+        self.__created_controllers.add(controller)
+        return ControllerState(controller, usb_version, {port: "" for port in range(1, num_ports + 1)})
+
+    # Device first, then the xenstore tree, the same order libxl uses when it removes a controller
+    async def __remove_controller(self, controller: int) -> None:
+        path = "/libxl/{}/device/vusb/{}".format(self.__domain_id, controller)
+        await self.__send_command_and_set_xenstore(partial(self.__qmp.remove_usb_controller, controller),
+                                                   [(path, None)], "remove", "controller {}".format(controller))
+        self.__created_controllers.discard(controller)
+        self.__idle_since.pop(controller, None)
+
+    async def __check_for_vusb(self) -> bool:
         path = "/libxl/{}/device".format(self.__domain_id)
-        devices = self.__get_xs_list(path)
+        try:
+            devices = await self.__get_xs_list(path)
+        except XenstoreError as e:
+            if e.errno == "ENOENT":
+                return False
+            raise
         return "vusb" in devices
 
-    async def __find_next_open_controller_and_port(self) -> Tuple[int, int]:
+    # Controllers written by older libxl versions have no usb-ver node; those are USB 3
+    async def __get_usb_version(self, path: str) -> int:
+        try:
+            return int(await self.__get_xs_value("{}/usb-ver".format(path)) or 3)
+        except XenstoreError as e:
+            if e.errno != "ENOENT":
+                raise
+            return 3
+
+    async def __get_controller(self, controller: str) -> ControllerState:
+        path = "/libxl/{}/device/vusb/{}".format(self.__domain_id, controller)
+        ports = await self.__get_xs_list("{}/port".format(path))
+        values = await asyncio.gather(self.__get_usb_version(path),
+                                      *(self.__get_xs_value("{}/port/{}".format(path, port)) for port in ports))
+        return ControllerState(int(controller), values[0], {int(p): v for p, v in zip(ports, values[1:])})
+
+    # Controllers on their way out are left out, so nothing is placed on them while they are removed
+    async def __get_controllers(self) -> List[ControllerState]:
         path = "/libxl/{}/device/vusb".format(self.__domain_id)
-        last_controller = -1
-
-        if self.__check_for_vusb():
-            for controller in self.__get_xs_list(path):
-                last_controller = int(controller)
-                c_path = "{}/{}/port".format(path, controller)
-                for port in self.__get_xs_list(c_path):
-                    d_path = "{}/{}".format(c_path, port)
-                    if self.__get_xs_value(d_path) == "":
-                        self.__options.print_verbose("Choosing Controller {0}, Slot {1}"
-                                                     .format(controller, port))
-                        return int(controller), int(port)
-
-        # Create a new controller
-        new_controller = last_controller + 1
-        self.__options.print_verbose("No available slot found, creating new controller id {}"
-                                     .format(new_controller))
-        await self.__create_controller(new_controller)
-        self.__options.print_verbose("Choosing Controller {}, Slot 1".format(new_controller))
-        return new_controller, 1
+        if not await self.__check_for_vusb():
+            return []
+
+        return list(await asyncio.gather(*(self.__get_controller(c) for c in await self.__get_xs_list(path)
+                                           if int(c) not in self.__retiring_controllers)))
+
+    # The slot is marked as taken in controllers, and a controller created for it is added there,
+    # so the next device in the same batch sees both
+    async def __allocate_slot(self, dev: Device, controllers: List[ControllerState]) -> Tuple[int, int]:
+        choice = self.__placement.choose(dev, controllers)
+        if choice is not None:
+            self.__options.print_verbose("Choosing Controller {0}, Slot {1}".format(*choice))
+        else:
+            # Create a new controller, under an id that isn't still being removed from QEMU
+            new_controller = max([c.controller for c in controllers] + list(self.__retiring_controllers),
+                                 default=-1) + 1
+            usb_version = self.__placement.controller_version(dev)
+            self.__options.print_verbose("No suitable slot found, creating new USB {} controller id {}"
+                                         .format(usb_version, new_controller))
+            controllers.append(await self.__create_controller(new_controller, usb_version))
+            self.__options.print_verbose("Choosing Controller {}, Slot 1".format(new_controller))
+            choice = new_controller, 1
+
+        next(s for s in controllers if s.controller == choice[0]).ports[choice[1]] = dev.sys_name
+        return choice
+
+    async def __find_next_open_controller_and_port(self, dev: Device) -> Tuple[int, int]:
+        return await self.__allocate_slot(dev, await self.__get_controllers())
+
+    # __find_remembered_slot for a batch, checked against the controllers already read
+    def __take_remembered_slot(self, dev: Device, controllers: List[ControllerState]) -> Optional[Tuple[int, int]]:
+        slot = self.__slots.recall(dev)
+        state = next((s for s in controllers if s.controller == slot[0]), None) if slot is not None else None
+        if state is None or state.ports.get(slot[1]) != "":
+            return None
+
+        state.ports[slot[1]] = dev.sys_name
+        self.__options.print_verbose("Re-using Controller {0}, Slot {1} for {2}".format(slot[0], slot[1],
+                                                                                       dev.sys_name))
+        return slot
 
     @property
     def domain_id(self) -> Optional[int]:
         return self.__domain_id
 
-    def get_domain_id(self, name: str) -> int:
-        for domain_id in self.__get_xs_list("/local/domain"):
-            path = "/local/domain/{}/name".format(domain_id)
-            if self.__get_xs_value(path) == name:
+    async def get_domain_id(self, name: str) -> int:
+        domain_ids = await self.__get_xs_list("/local/domain")
+        names = await asyncio.gather(*(self.__get_xs_value("/local/domain/{}/name".format(domain_id))
+                                       for domain_id in domain_ids), return_exceptions=True)
+        for domain_id, domain_name in zip(domain_ids, names):
+            if domain_name == name:
                 return int(domain_id)
         raise NameError("Could not find domain {}".format(name))
 
+    async def __connect(self) -> None:
+        await self.__xs_client.connect()
+        try:
+            self.__domain_id = await self.get_domain_id(self.__options.domain)
+        except BaseException:
+            self.__xs_client.close()
+            raise
+
     @staticmethod
-    async def wait_for_domain(opts: Options, qmp: Qmp) -> "XenDomain":
-        while True:
+    async def wait_for_domain(opts: Options, qmp: Qmp, retry: RetryScheduler,
+                              recorder: Optional[TraceRecorder] = None) -> "XenDomain":
+        warned = False
+
+        async def find_domain() -> "XenDomain":
+            nonlocal warned
+            domain = XenDomain(opts, qmp, recorder)
             try:
-                return XenDomain(opts, qmp)
+                await domain.__connect()
+                return domain
             except NameError:
                 if opts.no_wait:
                     opts.print_unless_quiet("Could not find domain {}, exiting.".format(opts.domain))
                     return XenDomain(None, qmp)
 
-                opts.print_unless_quiet("Could not find domain {}, waiting 5 seconds...".format(opts.domain))
-                await asyncio.sleep(5.0)
+                if not warned:
+                    opts.print_unless_quiet("Could not find domain {}, waiting...".format(opts.domain))
+                    warned = True
+                raise
 
-    async def attach_device_to_xen(self, dev: Device) -> XenUsb:
-        # Find an open controller and slot
-        controller, port = await self.__find_next_open_controller_and_port()
+        return await retry.run("wait for domain", find_domain, (NameError,), DOMAIN_RETRY_POLICY)
 
+    def __record_stage(self, name: str, start: float) -> None:
+        if self.__recorder is not None:
+            self.__recorder.stage(name, time.monotonic() - start)
+
+    # Fast path for a device we have seen before: if its last slot is still free, go straight back there
+    # without scanning every controller.  A slot that still names the device is not free: QEMU holds
+    # the old usb-host there until it is detached, so device_add would only fail.
+    async def __find_remembered_slot(self, dev: Device) -> Optional[Tuple[int, int]]:
+        slot = self.__slots.recall(dev)
+        if slot is None or slot[0] in self.__retiring_controllers:
+            return None
+
+        path = "/libxl/{}/device/vusb/{}/port/{}".format(self.__domain_id, *slot)
+        try:
+            if await self.__get_xs_value(path) != "":
+                return None
+        except XenstoreError:
+            self.__slots.forget(dev)
+            return None
+
+        self.__options.print_verbose("Re-using Controller {0}, Slot {1} for {2}".format(slot[0], slot[1],
+                                                                                       dev.sys_name))
+        return slot
+
+    # Choosing a slot and filling it happen under one lock, so two attaches can't pick the same free port
+    # and compaction can't remove a controller an attach has just chosen
+    async def attach_device_to_xen(self, dev: Device) -> XenUsb:
+        start = time.monotonic()
+        async with self.__allocation_lock:
+            # Find an open controller and slot
+            controller, port = await self.__find_remembered_slot(dev) or \
+                await self.__find_next_open_controller_and_port(dev)
+
+            xen_usb = await self.__attach_at(dev, controller, port)
+
+        self.__record_stage("attach", start)
+        return xen_usb
+
+    # For a burst of arrivals: every slot is chosen in one pass over a single read of the controllers, so
+    # the batch creates only the controllers it needs, and then all the attaches are sent together.
+    # Each device gets its XenUsb, or the XenError its attach failed with.
+    async def attach_devices_to_xen(self, devs: List[Device]) -> Dict[str, Union[XenUsb, "XenError"]]:
+        if len(devs) == 0:
+            return {}
+
+        start = time.monotonic()
+        results = {}
+        async with self.__allocation_lock:
+            controllers = await self.__get_controllers()
+            slots = []
+            for dev in devs:
+                try:
+                    controller, port = self.__take_remembered_slot(dev, controllers) or \
+                        await self.__allocate_slot(dev, controllers)
+                except XenError as e:
+                    results[dev.sys_name] = e
+                    continue
+                slots.append((dev, controller, port))
+
+            attached = await asyncio.gather(*(self.__attach_at(*slot) for slot in slots), return_exceptions=True)
+
+        # One device's failure, whatever it was, must not take the rest of the batch down with it
+        for (dev, _, _), result in zip(slots, attached):
+            if isinstance(result, Exception) and not isinstance(result, XenError):
+                if not isinstance(result, XenstoreError):
+                    self.__options.print_unless_quiet("Attaching {} failed: {!r}".format(dev.sys_name, result))
+                result = XenError(result)
+            elif isinstance(result, BaseException):
+                raise result
+            results[dev.sys_name] = result
+
+        self.__record_stage("attach batch", start)
+        return results
+
+    async def __attach_at(self, dev: Device, controller: int, port: int) -> XenUsb:
         # Add the entry to xenstore
         path = "/libxl/{}/device/vusb/{}/port/{}".format(self.__domain_id, controller, port)
         busnum = dev.busnum
         devnum = dev.devnum
+        tuning = self.__tuning.arguments(dev)
+        description = "{} ({}:{}) to controller {} port {}".format(dev.sys_name, busnum, devnum, controller, port)
+        if len(tuning) > 0:
+            description += " with {}".format(", ".join("{}={}".format(*t) for t in sorted(tuning.items())))
 
         await self.__set_xenstore_and_send_command([(path, dev.sys_name)],
-                                                   self.__get_qmp_add_usb(busnum, devnum, controller, port))
+                                                   self.__get_qmp_add_usb(busnum, devnum, controller, port, tuning),
+                                                   self.__get_qmp_del_usb(busnum, devnum), "attach", description)
 
+        self.__slots.remember(dev, controller, port)
         return XenUsb(controller, port, busnum, devnum)
 
+    # Only controllers this process created are ever removed; anything from the domain config
+    # or another tool is left alone.  A controller has to stay empty for the whole grace period.
+    # The guest can take its time releasing a PCI device, so the removal itself happens outside the
+    # allocation lock, with the controller hidden from placement.  One the guest won't let go of is
+    # left until it has been idle for another grace period.
+    async def reclaim_idle_controllers(self, grace: float) -> List[int]:
+        idle = []
+        async with self.__allocation_lock:
+            now = time.monotonic()
+            for state in await self.__get_controllers():
+                if state.controller not in self.__created_controllers:
+                    continue
+                if len(state.occupants) > 0:
+                    self.__idle_since.pop(state.controller, None)
+                    continue
+
+                idle_since = self.__idle_since.setdefault(state.controller, now)
+                if now - idle_since < grace:
+                    continue
+
+                self.__options.print_verbose("Removing controller {}, idle for {:.0f}s".format(state.controller,
+                                                                                              now - idle_since))
+                idle.append(state.controller)
+            self.__retiring_controllers.update(idle)
+
+        removed = []
+        for controller in idle:
+            try:
+                await self.__remove_controller(controller)
+                removed.append(controller)
+            except XenError as e:
+                self.__options.print_unless_quiet("Could not remove controller {}, trying again in {:.0f}s: {}"
+                                                  .format(controller, grace, e))
+                self.__idle_since[controller] = time.monotonic()
+            finally:
+                self.__retiring_controllers.discard(controller)
+
+        return removed
+
+    # Empty the least used of our controllers, if the placement policy can fit its devices elsewhere.
+    # Each move is a detach and attach, so the guest sees the device unplugged and plugged back in.
+    # Returns the new mapping of every device that was moved; None means it was detached but could not
+    # be attached again anywhere.
+    async def consolidate_controllers(self) -> Dict[str, Tuple[Device, Optional[XenUsb]]]:
+        moved = {}
+        async with self.__allocation_lock:
+            controllers = await self.__get_controllers()
+            candidates = sorted((s for s in controllers
+                                 if s.controller in self.__created_controllers and len(s.occupants) > 0),
+                                key=lambda s: (len(s.occupants), -s.controller))
+            if len(candidates) == 0:
+                return moved
+
+            sparsest = candidates[0]
+            moves = self.__placement.relocate(sparsest, controllers)
+            if moves is None:
+                return moved
+
+            self.__options.print_verbose("Consolidating controller {}".format(sparsest.controller))
+            for dev, controller, port in moves:
+                old_port = next(p for p, s in sparsest.ports.items() if s == dev.sys_name)
+                try:
+                    await self.detach_device_from_xen(XenUsb(sparsest.controller, old_port, dev.busnum, dev.devnum))
+                except XenError:
+                    break
+
+                try:
+                    moved[dev.sys_name] = (dev, await self.__attach_at(dev, controller, port))
+                except XenError:
+                    try:
+                        moved[dev.sys_name] = (dev, await self.__attach_at(dev, sparsest.controller, old_port))
+                    except XenError:
+                        moved[dev.sys_name] = (dev, None)
+
+        return moved
+
     async def detach_device_from_xen(self, device: XenUsb) -> bool:
         if device.hostaddr <= 0:
             # We don't have enough information to remove it.  Just leave things alone.
@@ -144,41 +479,97 @@ class XenDomain:
                                               "controller {}, port {}".format(device.controller, device.port))
             return False
 
+        start = time.monotonic()
         path = "/libxl/{}/device/vusb/{}/port/{}".format(self.__domain_id, device.controller, device.port)
-        await self.__set_xenstore_and_send_command([(path, "")], self.__get_qmp_del_usb(device.hostbus,
-                                                                                        device.hostaddr))
-
+        await self.__send_command_and_set_xenstore(self.__get_qmp_del_usb(device.hostbus, device.hostaddr),
+                                                   [(path, "")], "detach",
+                                                   "{}:{} from controller {} port {}".format(device.hostbus,
+                                                                                            device.hostaddr,
+                                                                                            device.controller,
+                                                                                            device.port))
+
+        self.__record_stage("detach", start)
         return True
 
-    async def find_device_mapping(self, sys_name: str) -> Optional[XenUsb]:
-        if self.__check_for_vusb():
-            path = "/libxl/{}/device/vusb".format(self.__domain_id)
-            for controller in self.__get_xs_list(path):
-                c_path = "{}/{}/port".format(path, controller)
-                for port in self.__get_xs_list(c_path):
-                    d_path = "{}/{}".format(c_path, port)
-                    if self.__get_xs_value(d_path) == sys_name:
-                        usb_host = await self.__qmp.get_usb_host(int(controller), int(port))
-                        if usb_host is not None:
-                            self.__options.print_verbose("Controller {}, Port {}, HostBus {}, HostAddress {}"
-                                                         .format(usb_host.controller,
-                                                                 usb_host.port,
-                                                                 usb_host.hostbus,
-                                                                 usb_host.hostaddr))
-                        else:
-                            self.__options.print_verbose("Device {} not found".format(sys_name))
-                        return usb_host
+    async def find_device_mapping(self, dev: Device) -> Optional[XenUsb]:
+        sys_name = dev.sys_name
+        for controller in await self.__get_controllers():
+            for port, port_sys_name in controller.ports.items():
+                if port_sys_name == sys_name:
+                    self.__slots.remember(dev, controller.controller, port)
+                    usb_host = await self.__qmp.get_usb_host(controller.controller, port)
+                    if usb_host is not None:
+                        self.__options.print_verbose("Controller {}, Port {}, HostBus {}, HostAddress {}"
+                                                     .format(usb_host.controller,
+                                                             usb_host.port,
+                                                             usb_host.hostbus,
+                                                             usb_host.hostaddr))
+                    else:
+                        self.__options.print_verbose("Device {} not found".format(sys_name))
+                    return usb_host
         return None
 
     def get_attached_devices(self) -> AsyncIterable:
         return self.__qmp.get_usb_devices()
 
-    def __init__(self, opts: Optional[Options], qmp: Qmp):
+    # QEMU has no way to hot-add a control monitor, so without a dedicated QMP socket we never see
+    # RESET or SHUTDOWN.  xenstore fires @releaseDomain whenever any domain goes away, though: if it was
+    # ours, a reboot shows up as a new domain with the same name shortly afterwards.
+    async def watch_lifecycle(self) -> None:
+        self.__xs_client.watch_fired += self.__lifecycle_watch_fired
+        await self.__xs_client.watch("@releaseDomain", LIFECYCLE_TOKEN)
+
+    async def __lifecycle_watch_fired(self, path: str, token: str) -> None:
+        if token != LIFECYCLE_TOKEN or self.__released:
+            return
+
+        try:
+            await self.__get_xs_value("/local/domain/{}/name".format(self.__domain_id))
+            return
+        except XenstoreError as e:
+            if e.errno != "ENOENT":
+                self.__options.print_debug("Checking domain {} after {}: {}".format(self.__domain_id, path, e))
+                return
+
+        self.__released = True
+        self.__options.print_verbose("Domain {} has gone away".format(self.__domain_id))
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + REBOOT_GRACE
+        while loop.time() < deadline:
+            try:
+                new_id = await self.get_domain_id(self.__options.domain)
+            except NameError:
+                await asyncio.sleep(REBOOT_POLL_INTERVAL)
+                continue
+            self.__options.print_verbose("Domain {} is back as {}".format(self.__options.domain, new_id))
+            await self.domain_reboot.fire()
+            return
+
+        await self.domain_shutdown.fire()
+
+    # From here on nothing is written to xenstore or sent to QEMU; the changes are collected in the plan
+    def begin_plan(self) -> Plan:
+        self.__plan = Plan()
+        return self.__plan
+
+    def __init__(self, opts: Optional[Options], qmp: Qmp, recorder: Optional[TraceRecorder] = None):
         self.__options = opts
         self.__qmp = qmp
-        with pyxs.Client() as self.__xs_client:
-            self.__domain_id = self.get_domain_id(self.__options.domain) if self.__options is not None else None
-        self.__xs_client = pyxs.Client()
+        self.__recorder = recorder
+        self.__placement = Placement(opts) if opts is not None else None
+        self.__tuning = UsbHostTuning(opts) if opts is not None else None
+        self.__slots = SlotMemory()
+        self.__xs_client = XenstoreClient(opts, recorder=recorder)
+        self.__domain_id = None
+        self.__plan = None
+        self.__released = False
+        self.__allocation_lock = asyncio.Lock()
+        self.__created_controllers: Set[int] = set()
+        self.__idle_since: Dict[int, float] = {}
+        self.__retiring_controllers: Set[int] = set()
+
+        self.domain_reboot = AsyncEvent()
+        self.domain_shutdown = AsyncEvent()
 
     def __repr__(self):
         return "XenDomain({!r}, {!r})".format(self.__options, self.__qmp)
@@ -187,7 +578,6 @@ class XenDomain:
         if self.__domain_id is None:
             return None
 
-        self.__xs_client.connect()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -0,0 +1,232 @@
+import asyncio
+import os
+import stat
+import struct
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .asyncevent import AsyncEvent
+from .options import Options
+from .trace import TraceRecorder
+
+# Message types from xen/include/public/io/xs_wire.h
+XS_DIRECTORY = 1
+XS_READ = 2
+XS_WATCH = 4
+XS_UNWATCH = 5
+XS_TRANSACTION_START = 6
+XS_TRANSACTION_END = 7
+XS_WRITE = 11
+XS_RM = 13
+XS_WATCH_EVENT = 15
+XS_ERROR = 16
+
+OPERATION_NAMES = {XS_DIRECTORY: "directory",
+                   XS_READ: "read",
+                   XS_WATCH: "watch",
+                   XS_UNWATCH: "unwatch",
+                   XS_TRANSACTION_START: "transaction",
+                   XS_TRANSACTION_END: "transaction-end",
+                   XS_WRITE: "write",
+                   XS_RM: "rm"}
+
+# struct xsd_sockmsg { uint32_t type, req_id, tx_id, len; }
+HEADER = struct.Struct("=IIII")
+MAX_PAYLOAD = 4096
+# xenstored answers in well under a millisecond; anything this slow is not coming
+REQUEST_TIMEOUT = 5.0
+
+XENSTORED_SOCKET = "/var/run/xenstored/socket"
+XENBUS_DEVICE = "/dev/xen/xenbus"
+
+
+# A xenstore client that speaks the wire protocol directly on the event loop.
+# Every request gets its own req_id, so any number of them can be in flight at once;
+# the reader task matches replies back to their futures and hands watch events to watch_fired.
+class XenstoreClient:
+    @staticmethod
+    def __get_path() -> str:
+        path = os.environ.get("XENSTORED_PATH")
+        if path is not None:
+            return path
+        return XENSTORED_SOCKET if os.path.exists(XENSTORED_SOCKET) else XENBUS_DEVICE
+
+    async def connect(self) -> None:
+        if self.__writer is not None:
+            return
+
+        self.__options.print_very_verbose("Connecting to xenstore at {}".format(self.__path))
+        if stat.S_ISCHR(os.stat(self.__path).st_mode):
+            self.__reader, self.__writer = await self.__open_xenbus()
+        else:
+            self.__reader, self.__writer = await asyncio.open_unix_connection(self.__path)
+
+        self.__reader_task = asyncio.ensure_future(self.__read_replies())
+
+    async def __open_xenbus(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        loop = asyncio.get_event_loop()
+        fd = os.open(self.__path, os.O_RDWR)
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(fd, "rb", 0))
+        transport, protocol = await loop.connect_write_pipe(asyncio.Protocol, os.fdopen(os.dup(fd), "wb", 0))
+        return reader, asyncio.StreamWriter(transport, protocol, reader, loop)
+
+    def close(self) -> None:
+        if self.__reader_task is not None:
+            self.__reader_task.cancel()
+        self.__disconnect(XenstoreError("EPIPE", "Connection closed"))
+
+    def __fail_pending(self, error: Exception) -> None:
+        for future in self.__pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self.__pending.clear()
+
+    def __fire_watch(self, payload: bytes) -> None:
+        try:
+            path, token = (p.decode("ascii") for p in payload.rstrip(b"\0").split(b"\0", 1))
+        except ValueError:
+            self.__options.print_debug("Ignoring malformed xenstore watch event {!r}".format(payload))
+            return
+        asyncio.ensure_future(self.watch_fired.fire(path, token))
+
+    # Once the reader stops, for whatever reason, nothing will ever answer the requests in flight or
+    # any sent later, so they all fail instead of waiting forever
+    async def __read_replies(self) -> None:
+        try:
+            while True:
+                header = await self.__reader.readexactly(HEADER.size)
+                msg_type, req_id, _, length = HEADER.unpack(header)
+                payload = await self.__reader.readexactly(length)
+
+                if msg_type == XS_WATCH_EVENT:
+                    self.__fire_watch(payload)
+                    continue
+
+                future = self.__pending.pop(req_id, None)
+                if future is None or future.done():
+                    self.__options.print_debug("Unexpected xenstore reply {} for request {}".format(msg_type,
+                                                                                                   req_id))
+                    continue
+
+                if msg_type == XS_ERROR:
+                    future.set_exception(XenstoreError(payload.rstrip(b"\0").decode("ascii", "replace")))
+                else:
+                    future.set_result(payload)
+        except asyncio.IncompleteReadError:
+            self.__disconnect(XenstoreError("EPIPE", "xenstored closed the connection"))
+        except Exception as e:
+            self.__options.print_unless_quiet("Lost the connection to xenstore: {!r}".format(e))
+            self.__disconnect(XenstoreError("EPIPE", "Connection to xenstored failed: {}".format(e)))
+
+    def __disconnect(self, error: "XenstoreError") -> None:
+        self.__reader_task = None
+        if self.__writer is not None:
+            self.__writer.close()
+            self.__writer = None
+            self.__reader = None
+        self.__fail_pending(error)
+
+    async def __request(self, msg_type: int, payload: bytes, tx_id: int = 0) -> bytes:
+        if self.__writer is None:
+            raise XenstoreError("ENOTCONN", "Not connected to xenstore")
+        if len(payload) > MAX_PAYLOAD:
+            raise XenstoreError("E2BIG", "Payload too large")
+
+        self.__next_req_id = (self.__next_req_id + 1) & 0xffffffff
+        req_id = self.__next_req_id
+        future = asyncio.get_event_loop().create_future()
+        self.__pending[req_id] = future
+
+        start = time.monotonic()
+        self.__writer.write(HEADER.pack(msg_type, req_id, tx_id, len(payload)) + payload)
+        try:
+            reply = await asyncio.wait_for(future, REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.__pending.pop(req_id, None)
+            self.__record(msg_type, payload, None, "ETIMEDOUT", start)
+            raise XenstoreError("ETIMEDOUT", "No reply to {} after {}s".format(
+                OPERATION_NAMES.get(msg_type, msg_type), REQUEST_TIMEOUT))
+        except XenstoreError as e:
+            self.__record(msg_type, payload, None, e.errno, start)
+            raise
+
+        self.__record(msg_type, payload, reply, None, start)
+        return reply
+
+    def __record(self, msg_type: int, payload: bytes, reply: Optional[bytes], error: Optional[str],
+                 start: float) -> None:
+        if self.__recorder is None:
+            return
+
+        op = OPERATION_NAMES.get(msg_type, str(msg_type))
+        self.__recorder.stage("xenstore {}".format(op), time.monotonic() - start)
+        parts = payload.split(b"\0", 1)
+        path = parts[0].decode("ascii")
+        value = parts[1].decode("ascii") if msg_type == XS_WRITE else None
+        result = reply.decode("ascii") if reply is not None and msg_type in (XS_READ, XS_DIRECTORY,
+                                                                             XS_TRANSACTION_START) else None
+        self.__recorder.xenstore(op, path, value, result, error)
+
+    @staticmethod
+    def __encode_path(path: str) -> bytes:
+        return bytes(path, "ascii") + b"\0"
+
+    async def read(self, path: str, tx_id: int = 0) -> str:
+        return (await self.__request(XS_READ, self.__encode_path(path), tx_id)).decode("ascii")
+
+    async def write(self, path: str, value: str, tx_id: int = 0) -> None:
+        await self.__request(XS_WRITE, self.__encode_path(path) + bytes(value, "ascii"), tx_id)
+
+    async def directory(self, path: str, tx_id: int = 0) -> List[str]:
+        reply = await self.__request(XS_DIRECTORY, self.__encode_path(path), tx_id)
+        return [name.decode("ascii") for name in reply.split(b"\0") if len(name) > 0]
+
+    async def rm(self, path: str, tx_id: int = 0) -> None:
+        await self.__request(XS_RM, self.__encode_path(path), tx_id)
+
+    async def transaction(self) -> int:
+        return int((await self.__request(XS_TRANSACTION_START, b"\0")).rstrip(b"\0"))
+
+    async def commit(self, tx_id: int) -> None:
+        await self.__request(XS_TRANSACTION_END, b"T\0", tx_id)
+
+    async def rollback(self, tx_id: int) -> None:
+        await self.__request(XS_TRANSACTION_END, b"F\0", tx_id)
+
+    async def watch(self, path: str, token: str) -> None:
+        await self.__request(XS_WATCH, self.__encode_path(path) + bytes(token, "ascii") + b"\0")
+
+    async def unwatch(self, path: str, token: str) -> None:
+        await self.__request(XS_UNWATCH, self.__encode_path(path) + bytes(token, "ascii") + b"\0")
+
+    def __init__(self, options: Options, path: Optional[str] = None, recorder: Optional[TraceRecorder] = None):
+        self.__options = options
+        self.__path = path or self.__get_path()
+        self.__recorder = recorder
+        self.__reader = None
+        self.__writer = None
+        self.__reader_task = None
+        self.__next_req_id = 0
+        self.__pending: Dict[int, asyncio.Future] = {}
+
+        self.watch_fired = AsyncEvent()
+
+    def __repr__(self):
+        return "XenstoreClient({!r}, {!r})".format(self.__options, self.__path)
+
+
+class XenstoreError(Exception):
+    @property
+    def errno(self) -> str:
+        return self.__errno
+
+    def __init__(self, errno: str, message: Optional[str] = None):
+        super().__init__(errno, message)
+        self.__errno = errno
+
+    def __repr__(self):
+        return "XenstoreError({!r})".format(self.__errno)
+
+    def __str__(self):
+        return self.__errno if self.args[1] is None else "{}: {}".format(self.__errno, self.args[1])
@@ -1,28 +1,31 @@
-class XenUsb:
-    @property
-    def controller(self) -> int:
-        return self.__controller
+from typing import NamedTuple, Tuple
 
-    @property
-    def port(self) -> int:
-        return self.__port
 
-    @property
-    def hostbus(self) -> int:
-        return self.__hostbus
+# An immutable value: two records for the same host device compare (and hash) equal
+# regardless of where it is attached, so attached devices can be reconciled with set operations.
+class XenUsb(NamedTuple):
+    controller: int
+    port: int
+    hostbus: int
+    hostaddr: int
 
     @property
-    def hostaddr(self) -> int:
-        return self.__hostaddr
+    def host_key(self) -> Tuple[int, int]:
+        return self.hostbus, self.hostaddr
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, XenUsb):
+            return NotImplemented
+        return self.host_key == other.host_key
 
-    def __init__(self, controller, port, hostbus, hostaddr):
-        self.__controller = controller
-        self.__port = port
-        self.__hostbus = hostbus
-        self.__hostaddr = hostaddr
+    # tuple has its own __ne__, which would still compare every field
+    def __ne__(self, other: object) -> bool:
+        if not isinstance(other, XenUsb):
+            return NotImplemented
+        return self.host_key != other.host_key
 
-    def __eq__(self, other: "XenUsb") -> bool:
-        return self.hostbus == other.hostbus and self.hostaddr == other.hostaddr
+    def __hash__(self) -> int:
+        return hash(self.host_key)
 
     def __repr__(self):
-        return "XenUsb({!r}, {!r}, {!r}, {!r})".format(self.__controller, self.__port, self.__hostbus, self.__hostaddr)
+        return "XenUsb({!r}, {!r}, {!r}, {!r})".format(self.controller, self.port, self.hostbus, self.hostaddr)
@@ -1,6 +1,7 @@
 #include <unistd.h>
 #include <string.h>
 #include <stdio.h>
+#include <stdlib.h>
 #include <sys/types.h>
 #include <linux/limits.h>
 
@@ -30,6 +31,27 @@ int main(int argc, char *argv[])
     char sudoUidEnv[strlen(sudoUidVariable) + 12];
     sprintf(sudoUidEnv, "%s=%d", sudoUidVariable, getuid());
     /*setreuid(geteuid(), geteuid());*/
-    char *environ[] = { env, sudoUidEnv, NULL };
+
+    /* Everything else is dropped, except what systemd needs to hear back from a Type=notify service */
+    const char *systemdVariables[] = { "NOTIFY_SOCKET", "WATCHDOG_USEC", "WATCHDOG_PID" };
+    const int systemdVariableCount = sizeof(systemdVariables) / sizeof(systemdVariables[0]);
+    char *environ[systemdVariableCount + 3];
+    int environCount = 0;
+    environ[environCount++] = env;
+    environ[environCount++] = sudoUidEnv;
+    for (int i = 0; i < systemdVariableCount; i++)
+    {
+        const char *value = getenv(systemdVariables[i]);
+        if (value == NULL)
+            continue;
+
+        char *variable = malloc(strlen(systemdVariables[i]) + strlen(value) + 2);
+        if (variable == NULL)
+            return 1;
+        sprintf(variable, "%s=%s", systemdVariables[i], value);
+        environ[environCount++] = variable;
+    }
+    environ[environCount] = NULL;
+
     return execve(scriptPath, argv, environ);
 }